@@ -1,16 +1,42 @@
 import asyncio
+import bisect
+import concurrent.futures
+import contextvars
+import functools
+import gzip
+import hashlib
+import heapq
+import hmac
+import json
 import logging
+import math
 import os
+import queue
+import re
 import secrets
+import shutil
 import sqlite3
+import sys
+import threading
 import time
+import zlib
+from abc import ABC, abstractmethod
+from array import array
+from collections import Counter, OrderedDict, deque
 from dataclasses import dataclass
 from datetime import date, datetime
-from typing import Optional, Tuple, Iterable
-
-from aiogram import Bot, Dispatcher, F
+from typing import Awaitable, Callable, Optional, Protocol, Tuple, Iterable, runtime_checkable
+
+from aiohttp import web
+from aiogram import BaseMiddleware, Bot, Dispatcher, F
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import (
+    TelegramBadRequest, TelegramForbiddenError, TelegramNetworkError, TelegramRetryAfter, TelegramServerError,
+)
 from aiogram.filters import CommandStart, Command
-from aiogram.types import Message, CallbackQuery
+from aiogram.types import (
+    CallbackQuery, InputMediaDocument, InputMediaPhoto, InputMediaVideo, Message,
+)
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
 logging.basicConfig(level=logging.INFO)
@@ -25,6 +51,59 @@ class Config:
     daily_limit_per_pair: int = 30
     default_block_links: int = 1
     inbox_limit: int = 12
+    db_readers: int = 4
+    rate_flush_sec: float = 5.0
+    cache_size: int = 50000
+    cache_ttl_sec: float = 300.0
+    send_workers: int = 8
+    send_global_rate: float = 30.0
+    send_chat_rate: float = 1.0
+    send_max_retries: int = 5
+    outbox_batch: int = 50
+    outbox_max_inflight: int = 200
+    outbox_max_attempts: int = 8
+    history_flush_sec: float = 2.0
+    history_page: int = 10
+    history_per_thread: int = 200
+    history_max_rows: int = 1_000_000
+    pending_ttl_sec: int = 86400
+    outbox_dead_keep_sec: int = 7 * 86400
+    thread_ttl_sec: int = 365 * 86400
+    sweep_interval_sec: float = 600.0
+    sweep_batch: int = 500
+    sweep_budget_sec: float = 2.0
+    sender_window_sec: float = 60.0
+    sender_max_per_window: int = 20
+    fanout_window_sec: float = 3600.0
+    fanout_max_recipients: int = 50
+    fanout_policy: str = "throttle"
+    filter_rules_path: str = ""
+    filter_reload_sec: float = 5.0
+    album_wait_sec: float = 0.8
+    report_digest_sec: float = 300.0
+    report_window_sec: int = 86400
+    report_autoban_threshold: int = 5
+    broadcast_page: int = 500
+    broadcast_report_sec: float = 60.0
+    backup_dir: str = ""
+    backup_interval_sec: float = 0.0
+    backup_keep: int = 7
+    backup_pages: int = 256
+    backup_sleep_sec: float = 0.005
+    mode: str = "polling"
+    max_concurrent_updates: int = 64
+    max_pending_updates: int = 10000
+    webhook_url: str = ""
+    webhook_path: str = "/webhook"
+    webhook_host: str = "127.0.0.1"
+    webhook_port: int = 8080
+    webhook_secret: str = ""
+    metrics_host: str = "127.0.0.1"
+    metrics_port: int = 0
+    record_path: str = ""
+    record_salt: str = ""
+    slow_query_ms: float = 0.0
+    trace_path: str = ""
 
 
 def utc_now_iso() -> str:
@@ -35,116 +114,1118 @@ def today_str() -> str:
     return date.today().isoformat()
 
 
+@dataclass(frozen=True)
+class Admission:
+    verdict: str
+    message: str = ""
+    thread_id: int = 0
+
+    @property
+    def ok(self) -> bool:
+        return self.verdict == "ok"
+
+
 def has_link(text: str) -> bool:
     t = (text or "").lower()
     return ("http://" in t) or ("https://" in t) or ("t.me/" in t)
 
 
+def url_domain(url: str) -> str:
+    u = url.strip().lower()
+    if "://" in u:
+        u = u.split("://", 1)[1]
+    u = re.split(r"[/?#:]", u, 1)[0]
+    return u[4:] if u.startswith("www.") else u
+
+
+@dataclass(frozen=True)
+class FilterVerdict:
+    has_link: bool = False
+    reject: str = ""
+
+
+class ContentFilter:
+    LINK_RE = r"(?P<url>(?:https?://|www\.)[^\s<>\"']+|(?<![\w.])t\.me/[^\s<>\"']*)"
+    DENY_TEXT = "Сообщение содержит запрещённую ссылку."
+    WORD_TEXT = "Сообщение содержит запрещённые слова."
+    RAW_ENTITIES = frozenset({"code", "pre"})
+
+    def __init__(self, path: str = "", reload_sec: float = 5.0):
+        self.path = path
+        self.reload_sec = reload_sec
+        self._mtime: Optional[float] = None
+        self._checked = float("-inf")
+        self.deny: frozenset = frozenset()
+        self.allow: frozenset = frozenset()
+        self._rules = False
+        self._re = self._compile((), ())
+        self.maybe_reload()
+
+    def _compile(self, deny: Iterable[str], words: Iterable[str]) -> "re.Pattern":
+        parts = [self.LINK_RE]
+        deny = sorted(deny, key=len, reverse=True)
+        words = sorted(words, key=len, reverse=True)
+        if deny:
+            parts.append(r"(?P<deny>(?<![\w.-])(?:" + "|".join(map(re.escape, deny)) + r")(?![\w-]))")
+        if words:
+            parts.append(r"(?P<word>\b(?:" + "|".join(map(re.escape, words)) + r")\b)")
+        return re.compile("|".join(parts), re.IGNORECASE)
+
+    def load(self, rules: dict) -> None:
+        deny = frozenset(d.lower() for d in rules.get("deny_domains", ()))
+        allow = frozenset(d.lower() for d in rules.get("allow_domains", ()))
+        words = [w.lower() for w in rules.get("banned_words", ())]
+        self._re = self._compile(deny, words)
+        self._rules = bool(deny or words)
+        self.deny, self.allow = deny, allow
+
+    def maybe_reload(self) -> None:
+        if not self.path:
+            return
+        now = time.monotonic()
+        if now - self._checked < self.reload_sec:
+            return
+        self._checked = now
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            return
+        if mtime == self._mtime:
+            return
+        self._mtime = mtime
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                self.load(json.load(f))
+        except (OSError, ValueError):
+            logging.exception("filter rules reload failed, keeping previous rules")
+            return
+        logging.info("filter rules loaded from %s", self.path)
+
+    def _match(self, domain: str, domains: frozenset) -> bool:
+        if not domains:
+            return False
+        while domain:
+            if domain in domains:
+                return True
+            domain = domain.partition(".")[2]
+        return False
+
+    def scan(self, text: str, entities=None) -> FilterVerdict:
+        self.maybe_reload()
+        links = []
+        raw_spans = False
+        for e in entities or ():
+            if e.type == "text_link" and e.url:
+                links.append(e.url)
+            elif e.type == "url":
+                links.append(e.extract_from(text))
+            elif e.type in self.RAW_ENTITIES:
+                raw_spans = True
+        fallback = not links or raw_spans
+        if self._rules:
+            scan_text = bool(text)
+        else:
+            scan_text = fallback and (has_link(text) or "www." in text.lower())
+        if scan_text:
+            for m in self._re.finditer(text):
+                g = m.lastgroup
+                if g == "word":
+                    return FilterVerdict(reject=self.WORD_TEXT)
+                if g == "deny":
+                    return FilterVerdict(reject=self.DENY_TEXT)
+                if fallback:
+                    links.append(m.group())
+        found = False
+        for u in links:
+            d = url_domain(u)
+            if self.deny and self._match(d, self.deny):
+                return FilterVerdict(reject=self.DENY_TEXT)
+            if not self._match(d, self.allow):
+                found = True
+        return FilterVerdict(has_link=found)
+
+    def scan_message(self, msg: Message) -> FilterVerdict:
+        if msg.text is not None:
+            return self.scan(msg.text, msg.entities)
+        return self.scan(msg.caption or "", msg.caption_entities)
+
+
+_MISS = object()
+
+_M64 = (1 << 64) - 1
+
+
+def mix64(x: int) -> int:
+    x = (x + 0x9E3779B97F4A7C15) & _M64
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & _M64
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & _M64
+    return x ^ (x >> 31)
+
+
+class HyperLogLog:
+    __slots__ = ("p", "m", "reg")
+
+    def __init__(self, p: int = 8):
+        self.p = p
+        self.m = 1 << p
+        self.reg = bytearray(self.m)
+
+    def add(self, value: int) -> None:
+        h = mix64(value)
+        idx = h >> (64 - self.p)
+        rest = h & ((1 << (64 - self.p)) - 1)
+        rank = (64 - self.p) - rest.bit_length() + 1
+        if rank > self.reg[idx]:
+            self.reg[idx] = rank
+
+    def count(self) -> int:
+        m = self.m
+        est = (0.7213 / (1 + 1.079 / m)) * m * m / sum(2.0 ** -r for r in self.reg)
+        zeros = self.reg.count(0)
+        if est <= 2.5 * m and zeros:
+            est = m * math.log(m / zeros)
+        return int(round(est))
+
+
+class SenderGuard:
+    PRUNE_EVERY = 10000
+
+    def __init__(self, window_sec: float, max_per_window: int, fanout_window_sec: float, fanout_max: int, policy: str):
+        self.window_sec = window_sec
+        self.max_per_window = max_per_window
+        self.fanout_window_sec = fanout_window_sec
+        self.fanout_max = fanout_max
+        self.policy = policy
+        self._sent: dict[int, deque] = {}
+        self._fanout: dict[int, list] = {}
+        self._calls = 0
+        self.throttled = 0
+        self.flagged = 0
+
+    def _prune(self, now: float) -> None:
+        self._sent = {k: d for k, d in self._sent.items() if d and now - d[-1] < self.window_sec}
+        self._fanout = {k: f for k, f in self._fanout.items() if now - f[0] < self.fanout_window_sec}
+
+    def _fanout_check(self, sender_id: int, recipient_id: int, now: float) -> Tuple[bool, str, int]:
+        f = self._fanout.get(sender_id)
+        if f is None or now - f[0] >= self.fanout_window_sec:
+            f = self._fanout[sender_id] = [now, HyperLogLog(), False]
+        f[1].add(recipient_id)
+        n = f[1].count()
+        if n <= self.fanout_max:
+            return False, "", 0
+        if self.policy == "flag":
+            if f[2]:
+                return False, "", 0
+            f[2] = True
+            self.flagged += 1
+            return False, "", n
+        self.throttled += 1
+        return True, "Слишком много разных получателей. Попробуйте позже.", 0
+
+    def check_message(self, sender_id: int) -> Tuple[bool, str]:
+        now = time.monotonic()
+        self._calls += 1
+        if self._calls % self.PRUNE_EVERY == 0:
+            self._prune(now)
+        d = self._sent.get(sender_id)
+        if d is None:
+            d = self._sent[sender_id] = deque(maxlen=self.max_per_window)
+        while d and now - d[0] >= self.window_sec:
+            d.popleft()
+        if len(d) >= self.max_per_window:
+            self.throttled += 1
+            return True, "Слишком много сообщений. Попробуйте позже."
+        d.append(now)
+        return False, ""
+
+    def check_link(self, sender_id: int, recipient_id: int) -> Tuple[bool, str, int]:
+        return self._fanout_check(sender_id, recipient_id, time.monotonic())
+
+    def stats(self) -> dict:
+        return {"tracked": len(self._fanout), "throttled": self.throttled, "flagged": self.flagged}
+
+
+class EventRate:
+    def __init__(self, window_sec: int = 60):
+        self.window_sec = window_sec
+        self._counts = [0] * window_sec
+        self._stamps = [0] * window_sec
+        self.total = 0
+
+    def add(self, n: int = 1) -> None:
+        sec = int(time.monotonic())
+        i = sec % self.window_sec
+        if self._stamps[i] != sec:
+            self._stamps[i] = sec
+            self._counts[i] = 0
+        self._counts[i] += n
+        self.total += n
+
+    def count(self) -> int:
+        now = int(time.monotonic())
+        return sum(c for c, ts in zip(self._counts, self._stamps) if now - ts < self.window_sec)
+
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    __slots__ = ("counts", "sum", "errors")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+        self.errors = 0
+
+    def observe(self, sec: float, error: bool = False) -> None:
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, sec)] += 1
+        self.sum += sec
+        if error:
+            self.errors += 1
+
+
+class Metrics:
+    def __init__(self, prefix: str = "anon"):
+        self.prefix = prefix
+        self._hist: dict[Tuple[str, str], Histogram] = {}
+        self._collectors: list[Callable[[], dict]] = []
+        self.tracer: Optional["Tracer"] = None
+
+    def observe(self, family: str, labels: str, sec: float, error: bool = False) -> None:
+        h = self._hist.get((family, labels))
+        if h is None:
+            h = self._hist[(family, labels)] = Histogram()
+        h.observe(sec, error)
+
+    def record(self, family: str, labels: str, name: str, t0: float, error: bool) -> None:
+        dt = time.perf_counter() - t0
+        self.observe(family, labels, dt, error)
+        if self.tracer is not None:
+            self.tracer.add(family, name, t0, dt)
+
+    def timed(self, family: str, labels: str):
+        name = labels.split('"')[1]
+
+        def wrap(fn):
+            @functools.wraps(fn)
+            async def call(*args, **kwargs):
+                t0 = time.perf_counter()
+                error = True
+                try:
+                    res = await fn(*args, **kwargs)
+                    error = False
+                    return res
+                finally:
+                    self.record(family, labels, name, t0, error)
+            return call
+        return wrap
+
+    def collect(self, fn: Callable[[], dict]) -> None:
+        self._collectors.append(fn)
+
+    def render(self) -> str:
+        lines: list[str] = []
+        items = sorted(self._hist.items())
+        family = None
+        for (fam, labels), h in items:
+            name = f"{self.prefix}_{fam}"
+            if fam != family:
+                family = fam
+                lines.append(f"# TYPE {name} histogram")
+            acc = 0
+            for le, c in zip(LATENCY_BUCKETS, h.counts):
+                acc += c
+                lines.append(f'{name}_bucket{{{labels},le="{le}"}} {acc}')
+            acc += h.counts[-1]
+            lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {acc}')
+            lines.append(f"{name}_sum{{{labels}}} {h.sum:.6f}")
+            lines.append(f"{name}_count{{{labels}}} {acc}")
+        family = None
+        for (fam, labels), h in items:
+            name = f"{self.prefix}_{fam}_errors_total"
+            if fam != family:
+                family = fam
+                lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{{{labels}}} {h.errors}")
+        for fn in self._collectors:
+            try:
+                values = fn()
+            except Exception:
+                logging.exception("metrics collector failed")
+                continue
+            lines.extend(f"{self.prefix}_{k} {v}" for k, v in values.items())
+        return "\n".join(lines) + "\n"
+
+
+TRACE_ID: contextvars.ContextVar[int] = contextvars.ContextVar("trace_id", default=0)
+
+
+class Tracer(BaseMiddleware):
+    FLUSH_SEC = 1.0
+
+    def __init__(self, path: str, max_events: int = 1_000_000):
+        self.path = path
+        self.max_events = max_events
+        self.written = 0
+        self.dropped = 0
+        self._events: list[dict] = []
+        self._t0 = time.perf_counter()
+        self._pid = os.getpid()
+
+    def add(self, cat: str, name: str, t0: float, dt: float) -> None:
+        if self.written + len(self._events) >= self.max_events:
+            self.dropped += 1
+            return
+        self._events.append({
+            "name": name, "cat": cat, "ph": "X", "pid": self._pid, "tid": TRACE_ID.get(),
+            "ts": round((t0 - self._t0) * 1e6, 1), "dur": round(dt * 1e6, 1),
+        })
+
+    async def __call__(self, handler, event, data):
+        token = TRACE_ID.set(event.update_id)
+        t0 = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            self.add("update", event.event_type, t0, time.perf_counter() - t0)
+            TRACE_ID.reset(token)
+
+    def _write(self, events: list[dict], first: bool) -> None:
+        with open(self.path, "w" if first else "a", encoding="utf-8") as f:
+            if first:
+                f.write("[\n")
+            f.write("".join(json.dumps(e) + ",\n" for e in events))
+
+    async def flush(self) -> None:
+        if not self._events:
+            return
+        events, self._events = self._events, []
+        first = self.written == 0
+        self.written += len(events)
+        await asyncio.to_thread(self._write, events, first)
+
+
+def param_shape(params) -> str:
+    def one(v) -> str:
+        if isinstance(v, (str, bytes)):
+            return f"{type(v).__name__}[{len(v)}]"
+        return type(v).__name__
+    if isinstance(params, dict):
+        return "{" + ", ".join(f"{k}: {one(v)}" for k, v in params.items()) + "}"
+    return "(" + ", ".join(one(v) for v in params) + ")"
+
+
+class TracedCursor(sqlite3.Cursor):
+    _sql: Optional[str] = None
+    _params = ()
+    _spent = 0.0
+
+    def execute(self, sql, params=()):
+        self._report()
+        self._sql, self._params, self._spent = sql, params, 0.0
+        t0 = time.perf_counter()
+        try:
+            return super().execute(sql, params)
+        finally:
+            self._spent += time.perf_counter() - t0
+            if self.description is None:
+                self._report()
+
+    def fetchone(self):
+        t0 = time.perf_counter()
+        try:
+            row = super().fetchone()
+        finally:
+            self._spent += time.perf_counter() - t0
+        if row is None:
+            self._report()
+        return row
+
+    def fetchmany(self, size=None):
+        t0 = time.perf_counter()
+        try:
+            rows = super().fetchmany(self.arraysize if size is None else size)
+        finally:
+            self._spent += time.perf_counter() - t0
+        if not rows:
+            self._report()
+        return rows
+
+    def fetchall(self):
+        t0 = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            self._spent += time.perf_counter() - t0
+            self._report()
+
+    def __next__(self):
+        t0 = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._spent += time.perf_counter() - t0
+            self._report()
+            raise
+        self._spent += time.perf_counter() - t0
+        return row
+
+    def close(self):
+        self._report()
+        super().close()
+
+    def __del__(self):
+        self._report()
+
+    def _report(self) -> None:
+        sql, self._sql = self._sql, None
+        if sql is not None and self._spent >= self.connection.slow_sec:
+            self.connection.on_slow(self.connection, sql, self._params, param_shape(self._params), self._spent)
+
+
+class TracedConnection(sqlite3.Connection):
+    slow_sec = 0.0
+    on_slow: Optional[Callable] = None
+
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq):
+        seq = list(seq)
+        t0 = time.perf_counter()
+        try:
+            return super().executemany(sql, seq)
+        finally:
+            dt = time.perf_counter() - t0
+            if dt >= self.slow_sec:
+                shape = f"{len(seq)} x {param_shape(seq[0])}" if seq else "0 rows"
+                self.on_slow(self, sql, seq[0] if seq else (), shape, dt)
+
+    def commit(self):
+        t0 = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            dt = time.perf_counter() - t0
+            if dt >= self.slow_sec:
+                self.on_slow(self, "COMMIT", (), "()", dt)
+
+
+class TTLCache:
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.gen = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] < now:
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return _MISS
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, key, value, gen: int) -> None:
+        with self._lock:
+            if gen != self.gen:
+                return
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key) -> None:
+        with self._lock:
+            self.gen += 1
+            self._data.pop(key, None)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits, "misses": self.misses, "evictions": self.evictions, "size": len(self._data),
+            "hit_pct": round(100.0 * self.hits / lookups, 1) if lookups else 0.0,
+        }
+
+
+class AccessIndex:
+    def __init__(self):
+        self.banned: set[int] = set()
+        self.blocks: dict[int, array] = {}
+        self._lock = threading.Lock()
+
+    def load(self, con: sqlite3.Connection) -> None:
+        banned = {int(r[0]) for r in con.execute("SELECT user_id FROM global_bans")}
+        blocks: dict[int, array] = {}
+        for r in con.execute("SELECT recipient_id, sender_id FROM blocks ORDER BY recipient_id, sender_id"):
+            blocks.setdefault(int(r[0]), array("q")).append(int(r[1]))
+        with self._lock:
+            self.banned = banned
+            self.blocks = blocks
+
+    def is_banned(self, user_id: int) -> bool:
+        return user_id in self.banned
+
+    def is_blocked(self, recipient_id: int, sender_id: int) -> bool:
+        arr = self.blocks.get(recipient_id)
+        if not arr:
+            return False
+        with self._lock:
+            i = bisect.bisect_left(arr, sender_id)
+            return i < len(arr) and arr[i] == sender_id
+
+    def ban(self, user_id: int) -> None:
+        with self._lock:
+            self.banned.add(user_id)
+
+    def unban(self, user_id: int) -> None:
+        with self._lock:
+            self.banned.discard(user_id)
+
+    def block(self, recipient_id: int, sender_id: int) -> None:
+        with self._lock:
+            arr = self.blocks.setdefault(recipient_id, array("q"))
+            i = bisect.bisect_left(arr, sender_id)
+            if i == len(arr) or arr[i] != sender_id:
+                arr.insert(i, sender_id)
+
+    def stats(self) -> dict:
+        return {"banned": len(self.banned), "block_recipients": len(self.blocks)}
+
+
+def rate_verdict(
+    last_ts: Optional[float], day: str, day_count: int, now: float, today: str, cooldown_sec: int, daily_limit: int,
+) -> Tuple[bool, str, int]:
+    if last_ts is None:
+        return False, "", 1
+
+    if now - last_ts < cooldown_sec:
+        wait = max(1, int(cooldown_sec - (now - last_ts)))
+        return True, f"Слишком часто. Подожди {wait} сек.", day_count
+
+    if day != today:
+        day_count = 0
+
+    if day_count + 1 > daily_limit:
+        return True, "Дневной лимит на сообщения этому пользователю исчерпан.", day_count
+
+    return False, "", day_count + 1
+
+
+class RateLimiter(ABC):
+    def load(self, con: sqlite3.Connection) -> None:
+        pass
+
+    @abstractmethod
+    def check(self, con: sqlite3.Connection, sender_id: int, recipient_id: int, cooldown_sec: int, daily_limit: int) -> Tuple[bool, str]:
+        ...
+
+    def flush(self, con: sqlite3.Connection) -> int:
+        return 0
+
+
+class SqlRateLimiter(RateLimiter):
+    def check(self, con: sqlite3.Connection, sender_id: int, recipient_id: int, cooldown_sec: int, daily_limit: int) -> Tuple[bool, str]:
+        row = con.execute(
+            "SELECT last_ts, day, day_count FROM rate_pair WHERE sender_id=? AND recipient_id=?",
+            (sender_id, recipient_id),
+        ).fetchone()
+        now = time.time()
+        today = today_str()
+        if not row:
+            limited, reason, count = rate_verdict(None, today, 0, now, today, cooldown_sec, daily_limit)
+        else:
+            limited, reason, count = rate_verdict(
+                float(row["last_ts"]), str(row["day"]), int(row["day_count"]), now, today, cooldown_sec, daily_limit
+            )
+        if limited:
+            return True, reason
+        con.execute(
+            "INSERT INTO rate_pair(sender_id, recipient_id, last_ts, day, day_count) VALUES(?,?,?,?,?) "
+            "ON CONFLICT(sender_id, recipient_id) DO UPDATE SET "
+            "last_ts=excluded.last_ts, day=excluded.day, day_count=excluded.day_count",
+            (sender_id, recipient_id, now, today, count),
+        )
+        return False, ""
+
+
+class MemoryRateLimiter(RateLimiter):
+    IDLE_DROP_SEC = 3600
+
+    def __init__(self):
+        self._pairs: dict[Tuple[int, int], list] = {}
+        self._dirty: set[Tuple[int, int]] = set()
+        self._lock = threading.Lock()
+
+    def load(self, con: sqlite3.Connection) -> None:
+        today = today_str()
+        cutoff = time.time() - self.IDLE_DROP_SEC
+        with self._lock:
+            self._pairs.clear()
+            self._dirty.clear()
+            for r in con.execute("SELECT sender_id, recipient_id, last_ts, day, day_count FROM rate_pair"):
+                if str(r["day"]) != today and float(r["last_ts"]) < cutoff:
+                    continue
+                self._pairs[(int(r["sender_id"]), int(r["recipient_id"]))] = [
+                    float(r["last_ts"]), str(r["day"]), int(r["day_count"])
+                ]
+
+    def check(self, con: sqlite3.Connection, sender_id: int, recipient_id: int, cooldown_sec: int, daily_limit: int) -> Tuple[bool, str]:
+        key = (sender_id, recipient_id)
+        now = time.time()
+        today = today_str()
+        with self._lock:
+            st = self._pairs.get(key)
+            if st is None:
+                limited, reason, count = rate_verdict(None, today, 0, now, today, cooldown_sec, daily_limit)
+            else:
+                limited, reason, count = rate_verdict(st[0], st[1], st[2], now, today, cooldown_sec, daily_limit)
+            if limited:
+                return True, reason
+            self._pairs[key] = [now, today, count]
+            self._dirty.add(key)
+        return False, ""
+
+    def flush(self, con: sqlite3.Connection) -> int:
+        today = today_str()
+        cutoff = time.time() - self.IDLE_DROP_SEC
+        with self._lock:
+            rows = [(s, r, *self._pairs[(s, r)]) for s, r in self._dirty]
+            self._dirty.clear()
+            for key in [k for k, st in self._pairs.items() if st[1] != today and st[0] < cutoff]:
+                del self._pairs[key]
+        if rows:
+            con.executemany(
+                "INSERT INTO rate_pair(sender_id, recipient_id, last_ts, day, day_count) VALUES(?,?,?,?,?) "
+                "ON CONFLICT(sender_id, recipient_id) DO UPDATE SET "
+                "last_ts=excluded.last_ts, day=excluded.day, day_count=excluded.day_count",
+                rows,
+            )
+        return len(rows)
+
+
+def migrate_base(cur: sqlite3.Cursor) -> None:
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY,
+        code TEXT UNIQUE NOT NULL,
+        anon_enabled INTEGER NOT NULL DEFAULT 1,
+        block_links INTEGER NOT NULL DEFAULT 1,
+        created_at TEXT NOT NULL
+    )
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS blocks (
+        recipient_id INTEGER NOT NULL,
+        sender_id INTEGER NOT NULL,
+        created_at TEXT NOT NULL,
+        PRIMARY KEY (recipient_id, sender_id)
+    )
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS threads (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        recipient_id INTEGER NOT NULL,
+        sender_id INTEGER NOT NULL,
+        created_at TEXT NOT NULL,
+        updated_at TEXT NOT NULL DEFAULT '',
+        UNIQUE(recipient_id, sender_id)
+    )
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS pending (
+        user_id INTEGER PRIMARY KEY,
+        target_user_id INTEGER NOT NULL,
+        created_at TEXT NOT NULL
+    )
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS global_bans (
+        user_id INTEGER PRIMARY KEY,
+        created_at TEXT NOT NULL
+    )
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS rate_pair (
+        sender_id INTEGER NOT NULL,
+        recipient_id INTEGER NOT NULL,
+        last_ts REAL NOT NULL,
+        day TEXT NOT NULL,
+        day_count INTEGER NOT NULL,
+        PRIMARY KEY (sender_id, recipient_id)
+    )
+    """)
+    cols_users = {r[1] for r in cur.execute("PRAGMA table_info(users)").fetchall()}
+    if "anon_enabled" not in cols_users:
+        cur.execute("ALTER TABLE users ADD COLUMN anon_enabled INTEGER NOT NULL DEFAULT 1")
+    if "block_links" not in cols_users:
+        cur.execute("ALTER TABLE users ADD COLUMN block_links INTEGER NOT NULL DEFAULT 1")
+    if "created_at" not in cols_users:
+        cur.execute("ALTER TABLE users ADD COLUMN created_at TEXT NOT NULL DEFAULT ''")
+
+    cols_threads = {r[1] for r in cur.execute("PRAGMA table_info(threads)").fetchall()}
+    if "updated_at" not in cols_threads:
+        cur.execute("ALTER TABLE threads ADD COLUMN updated_at TEXT NOT NULL DEFAULT ''")
+    if "created_at" not in cols_threads:
+        cur.execute("ALTER TABLE threads ADD COLUMN created_at TEXT NOT NULL DEFAULT ''")
+
+
+def migrate_outbox(cur: sqlite3.Cursor) -> None:
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        idem_key TEXT UNIQUE NOT NULL,
+        chat_id INTEGER NOT NULL,
+        thread_id INTEGER NOT NULL,
+        sender_id INTEGER NOT NULL,
+        payload TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'queued',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_ts REAL NOT NULL,
+        last_error TEXT NOT NULL DEFAULT '',
+        created_at TEXT NOT NULL
+    )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS outbox_due ON outbox(status, next_ts)")
+
+
+def migrate_epoch_ts(cur: sqlite3.Cursor) -> None:
+    cur.execute("ALTER TABLE threads ADD COLUMN created_ts INTEGER NOT NULL DEFAULT 0")
+    cur.execute("ALTER TABLE threads ADD COLUMN updated_ts INTEGER NOT NULL DEFAULT 0")
+    cur.execute("ALTER TABLE pending ADD COLUMN created_ts INTEGER NOT NULL DEFAULT 0")
+    cur.execute(
+        "UPDATE threads SET created_ts=COALESCE(CAST(strftime('%s', NULLIF(created_at,'')) AS INTEGER), 0)"
+    )
+    cur.execute(
+        "UPDATE threads SET updated_ts=COALESCE(CAST(strftime('%s', NULLIF(updated_at,'')) AS INTEGER), created_ts)"
+    )
+    cur.execute(
+        "UPDATE pending SET created_ts=COALESCE(CAST(strftime('%s', NULLIF(created_at,'')) AS INTEGER), 0)"
+    )
+    cur.execute("CREATE INDEX IF NOT EXISTS threads_inbox ON threads(recipient_id, updated_ts, id, sender_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS rate_pair_day ON rate_pair(day, last_ts)")
+
+
+def migrate_unread(cur: sqlite3.Cursor) -> None:
+    cur.execute("ALTER TABLE threads ADD COLUMN unread INTEGER NOT NULL DEFAULT 0")
+    cur.execute("ALTER TABLE users ADD COLUMN unread_total INTEGER NOT NULL DEFAULT 0")
+    cur.execute("DROP INDEX IF EXISTS threads_inbox")
+    cur.execute("CREATE INDEX threads_inbox ON threads(recipient_id, updated_ts, id, sender_id, unread)")
+
+
+def migrate_messages(cur: sqlite3.Cursor) -> None:
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS messages (
+        id INTEGER PRIMARY KEY,
+        thread_id INTEGER NOT NULL,
+        ts INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        file_id TEXT,
+        body BLOB,
+        z INTEGER NOT NULL DEFAULT 0
+    )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS messages_thread ON messages(thread_id, id)")
+
+
+def migrate_sweep_indexes(cur: sqlite3.Cursor) -> None:
+    cur.execute("CREATE INDEX IF NOT EXISTS pending_created ON pending(created_ts)")
+
+
+def migrate_reports(cur: sqlite3.Cursor) -> None:
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS reports (
+        thread_id INTEGER NOT NULL,
+        reporter_id INTEGER NOT NULL,
+        sender_id INTEGER NOT NULL,
+        ts INTEGER NOT NULL,
+        digested INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (thread_id, reporter_id)
+    )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS reports_sender ON reports(sender_id, ts)")
+    cur.execute("CREATE INDEX IF NOT EXISTS reports_digest ON reports(digested, sender_id)")
+
+
+def migrate_broadcasts(cur: sqlite3.Cursor) -> None:
+    cur.execute("ALTER TABLE users ADD COLUMN active INTEGER NOT NULL DEFAULT 1")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS broadcasts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        text TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'running',
+        cursor INTEGER NOT NULL DEFAULT 0,
+        total INTEGER NOT NULL DEFAULT 0,
+        sent INTEGER NOT NULL DEFAULT 0,
+        failed INTEGER NOT NULL DEFAULT 0,
+        blocked INTEGER NOT NULL DEFAULT 0,
+        started_ts INTEGER NOT NULL,
+        updated_ts INTEGER NOT NULL
+    )
+    """)
+
+
+COUNTED_TABLES = (("users", "users"), ("threads", "threads"), ("bans", "global_bans"))
+
+
+def migrate_counters(cur: sqlite3.Cursor) -> None:
+    cur.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL) WITHOUT ROWID")
+    for name, table in COUNTED_TABLES:
+        cur.execute(f"INSERT OR REPLACE INTO counters(name, value) SELECT '{name}', COUNT(*) FROM {table}")
+        cur.execute(
+            f"CREATE TRIGGER IF NOT EXISTS {table}_count_ins AFTER INSERT ON {table} "
+            f"BEGIN UPDATE counters SET value=value+1 WHERE name='{name}'; END"
+        )
+        cur.execute(
+            f"CREATE TRIGGER IF NOT EXISTS {table}_count_del AFTER DELETE ON {table} "
+            f"BEGIN UPDATE counters SET value=value-1 WHERE name='{name}'; END"
+        )
+
+
+def migrate_thread_retention(cur: sqlite3.Cursor) -> None:
+    cur.execute("CREATE INDEX IF NOT EXISTS threads_updated ON threads(updated_ts) WHERE unread=0")
+
+
+OUTBOX_STATUSES = ("queued", "inflight", "sent", "dead")
+
+
+def migrate_outbox_counters(cur: sqlite3.Cursor) -> None:
+    for status in OUTBOX_STATUSES:
+        cur.execute(
+            "INSERT OR REPLACE INTO counters(name, value) SELECT ?, COUNT(*) FROM outbox WHERE status=?",
+            (f"outbox_{status}", status),
+        )
+    cur.execute(
+        "CREATE TRIGGER IF NOT EXISTS outbox_count_ins AFTER INSERT ON outbox "
+        "BEGIN UPDATE counters SET value=value+1 WHERE name='outbox_'||NEW.status; END"
+    )
+    cur.execute(
+        "CREATE TRIGGER IF NOT EXISTS outbox_count_del AFTER DELETE ON outbox "
+        "BEGIN UPDATE counters SET value=value-1 WHERE name='outbox_'||OLD.status; END"
+    )
+    cur.execute(
+        "CREATE TRIGGER IF NOT EXISTS outbox_count_upd AFTER UPDATE OF status ON outbox WHEN OLD.status<>NEW.status "
+        "BEGIN UPDATE counters SET value=value-1 WHERE name='outbox_'||OLD.status; "
+        "UPDATE counters SET value=value+1 WHERE name='outbox_'||NEW.status; END"
+    )
+
+
+MIGRATIONS = [
+    (1, migrate_base),
+    (2, migrate_outbox),
+    (3, migrate_epoch_ts),
+    (4, migrate_unread),
+    (5, migrate_messages),
+    (6, migrate_sweep_indexes),
+    (7, migrate_reports),
+    (8, migrate_broadcasts),
+    (9, migrate_counters),
+    (10, migrate_thread_retention),
+    (11, migrate_outbox_counters),
+]
+
+
+COMPRESS_MIN_BYTES = 512
+
+
+def pack_text(text: str) -> Tuple[Optional[bytes], int]:
+    if not text:
+        return None, 0
+    raw = text.encode("utf-8")
+    if len(raw) < COMPRESS_MIN_BYTES:
+        return raw, 0
+    return zlib.compress(raw, 6), 1
+
+
+def unpack_text(body: Optional[bytes], z: int) -> str:
+    if not body:
+        return ""
+    return (zlib.decompress(body) if z else bytes(body)).decode("utf-8")
+
+
+@runtime_checkable
+class Storage(Protocol):
+    def init(self) -> None: ...
+    def close(self) -> None: ...
+    def ensure_user(self, user_id: int, default_block_links: int) -> str: ...
+    def settings(self, user_id: int, default_block_links: int) -> dict: ...
+    def set_anon(self, user_id: int, enabled: bool) -> None: ...
+    def set_block_links(self, user_id: int, enabled: bool) -> None: ...
+    def user_by_code(self, code: str) -> Optional[int]: ...
+    def is_banned(self, user_id: int) -> bool: ...
+    def ban(self, user_id: int) -> None: ...
+    def unban(self, user_id: int) -> None: ...
+    def is_blocked(self, recipient_id: int, sender_id: int) -> bool: ...
+    def block(self, recipient_id: int, sender_id: int) -> None: ...
+    def set_pending(self, user_id: int, target_user_id: int) -> None: ...
+    def clear_pending(self, user_id: int) -> None: ...
+    def pending_target(self, user_id: int) -> Optional[int]: ...
+    def thread_id(self, recipient_id: int, sender_id: int, unread: int = 0) -> int: ...
+    def thread_parties(self, thread_id: int) -> Optional[Tuple[int, int]]: ...
+    def inbox_threads(self, recipient_id: int, limit: int, before: Optional[Tuple[int, int]] = None) -> list: ...
+    def unread_total(self, user_id: int) -> int: ...
+    def mark_read(self, thread_id: int) -> None: ...
+    def rate_check_and_touch(self, sender_id: int, recipient_id: int, cooldown_sec: int, daily_limit: int) -> Tuple[bool, str]: ...
+
+
 class Repo:
-    def __init__(self, path: str):
+    CACHE_KIB = 16384
+    MMAP_BYTES = 64 * 1024 * 1024
+    CACHED_STATEMENTS = 256
+
+    def __init__(
+        self,
+        path: str,
+        rate: Optional[RateLimiter] = None,
+        cache_size: int = 50000,
+        cache_ttl_sec: float = 300.0,
+        history_per_thread: int = 200,
+        history_max_rows: int = 1_000_000,
+        slow_query_ms: float = 0.0,
+    ):
         self.path = path
+        self.slow_sec = slow_query_ms / 1000
+        self.slow_queries = 0
+        self.rate = rate if rate is not None else MemoryRateLimiter()
+        self.cache = TTLCache(cache_size, cache_ttl_sec)
+        self.access = AccessIndex()
+        self.history_per_thread = history_per_thread
+        self.history_max_rows = history_max_rows
+        self._history: list[tuple] = []
+        self._history_lock = threading.Lock()
+        self._local = threading.local()
+        self._all: list[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+        self.opened = 0
+        self.statements = 0
+
+    def _count(self, _sql: str) -> None:
+        self.statements += 1
+
+    def _slow_query(self, con: sqlite3.Connection, sql: str, params, shape: str, dt: float) -> None:
+        self.slow_queries += 1
+        method = "?"
+        f = sys._getframe(2)
+        while f is not None:
+            if f.f_locals.get("self") is self:
+                method = f.f_code.co_name
+                break
+            f = f.f_back
+        plan = ""
+        if sql.lstrip()[:6].upper() in ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH"):
+            try:
+                rows = sqlite3.Connection.execute(con, "EXPLAIN QUERY PLAN " + sql, params).fetchall()
+                plan = "; ".join(str(r[3]) for r in rows)
+            except sqlite3.Error as e:
+                plan = f"n/a: {e}"
+        logging.warning(
+            "slow query %.1f ms in Repo.%s: %s params=%s plan=[%s]", dt * 1000, method, " ".join(sql.split()), shape, plan,
+        )
 
     def _con(self) -> sqlite3.Connection:
-        con = sqlite3.connect(self.path)
+        con = getattr(self._local, "con", None)
+        if con is not None:
+            return con
+        con = sqlite3.connect(
+            self.path, check_same_thread=False, cached_statements=self.CACHED_STATEMENTS,
+            factory=TracedConnection if self.slow_sec else sqlite3.Connection,
+        )
+        if self.slow_sec:
+            con.slow_sec = self.slow_sec
+            con.on_slow = self._slow_query
         con.row_factory = sqlite3.Row
+        con.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        con.execute("PRAGMA journal_mode = WAL")
+        con.execute("PRAGMA synchronous = NORMAL")
+        con.execute(f"PRAGMA cache_size = -{self.CACHE_KIB}")
+        con.execute(f"PRAGMA mmap_size = {self.MMAP_BYTES}")
+        con.execute("PRAGMA temp_store = MEMORY")
         con.execute("PRAGMA foreign_keys = ON")
+        con.set_trace_callback(self._count)
+        self._local.con = con
+        with self._lock:
+            self._all.append(con)
+            self.opened += 1
         return con
 
+    def close(self) -> None:
+        with self._lock:
+            for con in self._all:
+                con.close()
+            self._all.clear()
+        self._local = threading.local()
+
+    def counters(self) -> dict:
+        c = {
+            "connections_opened": self.opened, "connections_live": len(self._all),
+            "statements": self.statements, "slow_queries": self.slow_queries,
+        }
+        c.update({f"cache_{k}": v for k, v in self.cache.stats().items()})
+        c.update({f"index_{k}": v for k, v in self.access.stats().items()})
+        return c
+
     def init(self) -> None:
         con = self._con()
-        cur = con.cursor()
+        version = int(con.execute("PRAGMA user_version").fetchone()[0])
+        for v, step in MIGRATIONS:
+            if v <= version:
+                continue
+            con.execute("BEGIN IMMEDIATE")
+            try:
+                step(con.cursor())
+                con.execute(f"PRAGMA user_version = {v}")
+            except BaseException:
+                con.rollback()
+                raise
+            con.commit()
+            logging.info("schema migrated to v%s", v)
 
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY,
-            code TEXT UNIQUE NOT NULL,
-            anon_enabled INTEGER NOT NULL DEFAULT 1,
-            block_links INTEGER NOT NULL DEFAULT 1,
-            created_at TEXT NOT NULL
-        )
-        """)
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS blocks (
-            recipient_id INTEGER NOT NULL,
-            sender_id INTEGER NOT NULL,
-            created_at TEXT NOT NULL,
-            PRIMARY KEY (recipient_id, sender_id)
-        )
-        """)
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS threads (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            recipient_id INTEGER NOT NULL,
-            sender_id INTEGER NOT NULL,
-            created_at TEXT NOT NULL,
-            updated_at TEXT NOT NULL DEFAULT '',
-            UNIQUE(recipient_id, sender_id)
-        )
-        """)
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS pending (
-            user_id INTEGER PRIMARY KEY,
-            target_user_id INTEGER NOT NULL,
-            created_at TEXT NOT NULL
-        )
-        """)
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS global_bans (
-            user_id INTEGER PRIMARY KEY,
-            created_at TEXT NOT NULL
-        )
-        """)
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS rate_pair (
-            sender_id INTEGER NOT NULL,
-            recipient_id INTEGER NOT NULL,
-            last_ts REAL NOT NULL,
-            day TEXT NOT NULL,
-            day_count INTEGER NOT NULL,
-            PRIMARY KEY (sender_id, recipient_id)
-        )
-        """)
-
-        cols_users = {r[1] for r in cur.execute("PRAGMA table_info(users)").fetchall()}
-        if "anon_enabled" not in cols_users:
-            cur.execute("ALTER TABLE users ADD COLUMN anon_enabled INTEGER NOT NULL DEFAULT 1")
-        if "block_links" not in cols_users:
-            cur.execute("ALTER TABLE users ADD COLUMN block_links INTEGER NOT NULL DEFAULT 1")
-        if "created_at" not in cols_users:
-            cur.execute("ALTER TABLE users ADD COLUMN created_at TEXT NOT NULL DEFAULT ''")
-
-        cols_threads = {r[1] for r in cur.execute("PRAGMA table_info(threads)").fetchall()}
-        if "updated_at" not in cols_threads:
-            cur.execute("ALTER TABLE threads ADD COLUMN updated_at TEXT NOT NULL DEFAULT ''")
-        if "created_at" not in cols_threads:
-            cur.execute("ALTER TABLE threads ADD COLUMN created_at TEXT NOT NULL DEFAULT ''")
+        if int(con.execute("PRAGMA auto_vacuum").fetchone()[0]) != 2:
+            logging.info("switching %s to incremental auto_vacuum, running a one-time VACUUM", self.path)
+            con.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            con.execute("VACUUM")
 
+        con.execute("UPDATE outbox SET status='queued' WHERE status='inflight'")
         con.commit()
-        con.close()
+        self.rate.load(con)
+        self.access.load(con)
 
     def is_banned(self, user_id: int) -> bool:
-        con = self._con()
-        row = con.execute("SELECT 1 FROM global_bans WHERE user_id=?", (user_id,)).fetchone()
-        con.close()
-        return row is not None
+        return self.access.is_banned(user_id)
 
     def ban(self, user_id: int) -> None:
         con = self._con()
         con.execute("INSERT OR IGNORE INTO global_bans(user_id, created_at) VALUES(?,?)", (user_id, utc_now_iso()))
         con.commit()
-        con.close()
+        self.access.ban(user_id)
 
     def unban(self, user_id: int) -> None:
         con = self._con()
         con.execute("DELETE FROM global_bans WHERE user_id=?", (user_id,))
         con.commit()
-        con.close()
+        self.access.unban(user_id)
 
     def ensure_user(self, user_id: int, default_block_links: int) -> str:
         con = self._con()
-        row = con.execute("SELECT code FROM users WHERE user_id=?", (user_id,)).fetchone()
+        row = con.execute("SELECT code, active FROM users WHERE user_id=?", (user_id,)).fetchone()
         if row:
-            con.close()
+            if not row["active"]:
+                con.execute("UPDATE users SET active=1 WHERE user_id=?", (user_id,))
+                con.commit()
             return str(row["code"])
         code = secrets.token_urlsafe(8)
         con.execute(
@@ -152,47 +1233,51 @@ class Repo:
             (user_id, code, 1, default_block_links, utc_now_iso()),
         )
         con.commit()
-        con.close()
         return code
 
-    def settings(self, user_id: int, default_block_links: int) -> dict:
+    def user_settings(self, user_id: int) -> Optional[dict]:
+        key = ("settings", user_id)
+        hit = self.cache.get(key)
+        if hit is not _MISS:
+            return dict(hit)
+        gen = self.cache.gen
         con = self._con()
         row = con.execute(
             "SELECT anon_enabled, block_links, code FROM users WHERE user_id=?",
             (user_id,),
         ).fetchone()
-        con.close()
         if not row:
+            return None
+        s = {"anon_enabled": int(row["anon_enabled"]), "block_links": int(row["block_links"]), "code": str(row["code"])}
+        self.cache.put(key, s, gen)
+        return dict(s)
+
+    def settings(self, user_id: int, default_block_links: int) -> dict:
+        s = self.user_settings(user_id)
+        if s is None:
             code = self.ensure_user(user_id, default_block_links)
-            return {"anon_enabled": 1, "block_links": default_block_links, "code": code}
-        return {"anon_enabled": int(row["anon_enabled"]), "block_links": int(row["block_links"]), "code": str(row["code"])}
+            s = {"anon_enabled": 1, "block_links": default_block_links, "code": code}
+        return s
 
     def set_anon(self, user_id: int, enabled: bool) -> None:
         con = self._con()
         con.execute("UPDATE users SET anon_enabled=? WHERE user_id=?", (1 if enabled else 0, user_id))
         con.commit()
-        con.close()
+        self.cache.invalidate(("settings", user_id))
 
     def set_block_links(self, user_id: int, enabled: bool) -> None:
         con = self._con()
         con.execute("UPDATE users SET block_links=? WHERE user_id=?", (1 if enabled else 0, user_id))
         con.commit()
-        con.close()
+        self.cache.invalidate(("settings", user_id))
 
     def user_by_code(self, code: str) -> Optional[int]:
         con = self._con()
         row = con.execute("SELECT user_id FROM users WHERE code=?", (code,)).fetchone()
-        con.close()
         return int(row["user_id"]) if row else None
 
     def is_blocked(self, recipient_id: int, sender_id: int) -> bool:
-        con = self._con()
-        row = con.execute(
-            "SELECT 1 FROM blocks WHERE recipient_id=? AND sender_id=?",
-            (recipient_id, sender_id),
-        ).fetchone()
-        con.close()
-        return row is not None
+        return self.access.is_blocked(recipient_id, sender_id)
 
     def block(self, recipient_id: int, sender_id: int) -> None:
         con = self._con()
@@ -201,123 +1286,966 @@ class Repo:
             (recipient_id, sender_id, utc_now_iso()),
         )
         con.commit()
-        con.close()
+        self.access.block(recipient_id, sender_id)
 
     def set_pending(self, user_id: int, target_user_id: int) -> None:
         con = self._con()
         con.execute(
-            "INSERT INTO pending(user_id, target_user_id, created_at) VALUES(?,?,?) "
-            "ON CONFLICT(user_id) DO UPDATE SET target_user_id=excluded.target_user_id, created_at=excluded.created_at",
-            (user_id, target_user_id, utc_now_iso()),
+            "INSERT INTO pending(user_id, target_user_id, created_at, created_ts) VALUES(?,?,?,?) "
+            "ON CONFLICT(user_id) DO UPDATE SET target_user_id=excluded.target_user_id, "
+            "created_at=excluded.created_at, created_ts=excluded.created_ts",
+            (user_id, target_user_id, utc_now_iso(), int(time.time())),
         )
         con.commit()
-        con.close()
 
     def clear_pending(self, user_id: int) -> None:
         con = self._con()
         con.execute("DELETE FROM pending WHERE user_id=?", (user_id,))
         con.commit()
-        con.close()
 
     def pending_target(self, user_id: int) -> Optional[int]:
         con = self._con()
         row = con.execute("SELECT target_user_id FROM pending WHERE user_id=?", (user_id,)).fetchone()
-        con.close()
         return int(row["target_user_id"]) if row else None
 
-    def thread_id(self, recipient_id: int, sender_id: int) -> int:
-        con = self._con()
+    def _upsert_thread(self, con: sqlite3.Connection, recipient_id: int, sender_id: int, unread: int = 0) -> int:
+        now = utc_now_iso()
+        ts = int(time.time())
         row = con.execute(
-            "SELECT id FROM threads WHERE recipient_id=? AND sender_id=?",
-            (recipient_id, sender_id),
+            "INSERT INTO threads(recipient_id, sender_id, created_at, updated_at, created_ts, updated_ts, unread) "
+            "VALUES(?,?,?,?,?,?,?) ON CONFLICT(recipient_id, sender_id) DO UPDATE SET "
+            "updated_at=excluded.updated_at, updated_ts=excluded.updated_ts, unread=unread+excluded.unread RETURNING id",
+            (recipient_id, sender_id, now, now, ts, ts, unread),
         ).fetchone()
-        if row:
-            tid = int(row["id"])
-            con.execute("UPDATE threads SET updated_at=? WHERE id=?", (utc_now_iso(), tid))
-            con.commit()
-            con.close()
-            return tid
-        con.execute(
-            "INSERT INTO threads(recipient_id, sender_id, created_at, updated_at) VALUES(?,?,?,?)",
-            (recipient_id, sender_id, utc_now_iso(), utc_now_iso()),
-        )
+        if unread:
+            con.execute("UPDATE users SET unread_total=unread_total+? WHERE user_id=?", (unread, recipient_id))
+        return int(row["id"])
+
+    def thread_id(self, recipient_id: int, sender_id: int, unread: int = 0) -> int:
+        con = self._con()
+        tid = self._upsert_thread(con, recipient_id, sender_id, unread)
         con.commit()
-        tid = int(con.execute(
-            "SELECT id FROM threads WHERE recipient_id=? AND sender_id=?",
-            (recipient_id, sender_id),
-        ).fetchone()["id"])
-        con.close()
         return tid
 
     def thread_parties(self, thread_id: int) -> Optional[Tuple[int, int]]:
         con = self._con()
         row = con.execute("SELECT recipient_id, sender_id FROM threads WHERE id=?", (thread_id,)).fetchone()
-        con.close()
         if not row:
             return None
         return int(row["recipient_id"]), int(row["sender_id"])
 
-    def inbox_threads(self, recipient_id: int, limit: int) -> list[sqlite3.Row]:
+    def inbox_threads(self, recipient_id: int, limit: int, before: Optional[Tuple[int, int]] = None) -> list[sqlite3.Row]:
         con = self._con()
-        rows = con.execute(
-            "SELECT id, sender_id, updated_at, created_at FROM threads WHERE recipient_id=? "
-            "ORDER BY COALESCE(NULLIF(updated_at,''), created_at) DESC LIMIT ?",
-            (recipient_id, limit),
-        ).fetchall()
-        con.close()
+        if before is None:
+            rows = con.execute(
+                "SELECT id, sender_id, updated_ts, unread FROM threads WHERE recipient_id=? "
+                "ORDER BY updated_ts DESC, id DESC LIMIT ?",
+                (recipient_id, limit),
+            ).fetchall()
+        else:
+            rows = con.execute(
+                "SELECT id, sender_id, updated_ts, unread FROM threads WHERE recipient_id=? AND (updated_ts, id) < (?, ?) "
+                "ORDER BY updated_ts DESC, id DESC LIMIT ?",
+                (recipient_id, before[0], before[1], limit),
+            ).fetchall()
         return list(rows)
 
+    def unread_total(self, user_id: int) -> int:
+        con = self._con()
+        row = con.execute("SELECT unread_total FROM users WHERE user_id=?", (user_id,)).fetchone()
+        return int(row["unread_total"]) if row else 0
+
+    def mark_read(self, thread_id: int) -> None:
+        con = self._con()
+        row = con.execute("SELECT recipient_id, unread FROM threads WHERE id=?", (thread_id,)).fetchone()
+        if not row or not row["unread"]:
+            return
+        con.execute("UPDATE threads SET unread=0 WHERE id=?", (thread_id,))
+        con.execute(
+            "UPDATE users SET unread_total=MAX(0, unread_total-?) WHERE user_id=?",
+            (int(row["unread"]), int(row["recipient_id"])),
+        )
+        con.commit()
+
+    def _rate_touch(self, con: sqlite3.Connection, sender_id: int, recipient_id: int, cooldown_sec: int, daily_limit: int) -> Tuple[bool, str]:
+        return self.rate.check(con, sender_id, recipient_id, cooldown_sec, daily_limit)
+
     def rate_check_and_touch(self, sender_id: int, recipient_id: int, cooldown_sec: int, daily_limit: int) -> Tuple[bool, str]:
         con = self._con()
-        row = con.execute(
-            "SELECT last_ts, day, day_count FROM rate_pair WHERE sender_id=? AND recipient_id=?",
-            (sender_id, recipient_id),
-        ).fetchone()
+        res = self._rate_touch(con, sender_id, recipient_id, cooldown_sec, daily_limit)
+        con.commit()
+        return res
+
+    def admit_delivery(
+        self,
+        sender_id: int,
+        recipient_id: int,
+        default_block_links: int,
+        cooldown_sec: int,
+        daily_limit: int,
+        with_link: bool,
+        idem_key: str = "",
+        payload: Optional[dict] = None,
+    ) -> Admission:
+        con = self._con()
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            if idem_key and con.execute("SELECT 1 FROM outbox WHERE idem_key=?", (idem_key,)).fetchone():
+                adm = Admission("duplicate")
+            else:
+                row = con.execute(
+                    "SELECT anon_enabled, block_links FROM users WHERE user_id=?", (recipient_id,)
+                ).fetchone()
+                adm = self._admit(con, row, sender_id, recipient_id, default_block_links, cooldown_sec, daily_limit, with_link)
+                if adm.ok and payload is not None:
+                    self._outbox_put(con, idem_key, recipient_id, adm.thread_id, sender_id, payload)
+                    con.execute("DELETE FROM pending WHERE user_id=?", (sender_id,))
+        except BaseException:
+            con.rollback()
+            raise
+        con.commit()
+        return adm
+
+    def _admit(
+        self,
+        con: sqlite3.Connection,
+        row: Optional[sqlite3.Row],
+        sender_id: int,
+        recipient_id: int,
+        default_block_links: int,
+        cooldown_sec: int,
+        daily_limit: int,
+        with_link: bool,
+    ) -> Admission:
+        if self.access.is_banned(sender_id):
+            return Admission("banned", "Доступ ограничен.")
+
+        if self.access.is_banned(recipient_id) or self.access.is_blocked(recipient_id, sender_id):
+            con.execute("DELETE FROM pending WHERE user_id=?", (sender_id,))
+            return Admission("blocked", "Сообщение не доставлено.")
+
+        if row is not None and int(row["anon_enabled"]) == 0:
+            con.execute("DELETE FROM pending WHERE user_id=?", (sender_id,))
+            return Admission("disabled", "У пользователя отключены анонимные сообщения.")
+
+        limited, reason = self._rate_touch(con, sender_id, recipient_id, cooldown_sec, daily_limit)
+        if limited:
+            return Admission("limited", reason)
+
+        block_links = default_block_links if row is None else int(row["block_links"])
+        if block_links == 1 and with_link:
+            return Admission("links", "Ссылки запрещены у получателя. Уберите ссылку и попробуйте снова.")
+
+        return Admission("ok", thread_id=self._upsert_thread(con, recipient_id, sender_id, unread=1))
+
+    def _outbox_put(
+        self, con: sqlite3.Connection, idem_key: str, chat_id: int, thread_id: int, sender_id: int, payload: dict,
+    ) -> None:
+        con.execute(
+            "INSERT OR IGNORE INTO outbox(idem_key, chat_id, thread_id, sender_id, payload, next_ts, created_at) "
+            "VALUES(?,?,?,?,?,?,?)",
+            (idem_key or secrets.token_hex(8), chat_id, thread_id, sender_id,
+             json.dumps(payload, ensure_ascii=False), time.time(), utc_now_iso()),
+        )
+
+    def outbox_claim(self, limit: int) -> list[sqlite3.Row]:
+        con = self._con()
+        rows = con.execute(
+            "UPDATE outbox SET status='inflight' WHERE id IN ("
+            "SELECT id FROM outbox WHERE status='queued' AND next_ts<=? ORDER BY next_ts LIMIT ?"
+            ") RETURNING id, chat_id, thread_id, sender_id, payload, attempts",
+            (time.time(), limit),
+        ).fetchall()
+        con.commit()
+        return list(rows)
 
+    def outbox_done(self, ids: list[int], keep_sec: float = 86400) -> None:
+        con = self._con()
         now = time.time()
-        today = today_str()
+        con.executemany("UPDATE outbox SET status='sent', next_ts=? WHERE id=?", [(now, i) for i in ids])
+        con.execute(
+            "DELETE FROM outbox WHERE id IN (SELECT id FROM outbox WHERE status='sent' AND next_ts<? LIMIT 500)",
+            (now - keep_sec,),
+        )
+        con.commit()
 
-        if not row:
+    def outbox_fail(self, failures: list[Tuple[int, bool, str]], max_attempts: int) -> int:
+        con = self._con()
+        now = time.time()
+        dead = 0
+        for i, permanent, err in failures:
+            row = con.execute(
+                "UPDATE outbox SET attempts=attempts+1, last_error=?, "
+                "status=CASE WHEN ? OR attempts+1>=? THEN 'dead' ELSE 'queued' END, "
+                "next_ts=? + MIN(600, 5 * (1 << attempts)) WHERE id=? RETURNING status",
+                (err[:500], int(permanent), max_attempts, now, i),
+            ).fetchone()
+            dead += row is not None and row["status"] == "dead"
+        con.commit()
+        return dead
+
+    def log_message(self, thread_id: int, payload: dict) -> None:
+        body, z = pack_text(payload.get("text") or payload.get("caption") or "")
+        row = (thread_id, int(time.time()), payload["kind"], payload.get("file_id"), body, z)
+        with self._history_lock:
+            self._history.append(row)
+
+    def flush_messages(self) -> int:
+        with self._history_lock:
+            rows, self._history = self._history, []
+        if not rows:
+            return 0
+        con = self._con()
+        con.executemany("INSERT INTO messages(thread_id, ts, kind, file_id, body, z) VALUES(?,?,?,?,?,?)", rows)
+        for tid in {r[0] for r in rows}:
             con.execute(
-                "INSERT INTO rate_pair(sender_id, recipient_id, last_ts, day, day_count) VALUES(?,?,?,?,?)",
-                (sender_id, recipient_id, now, today, 1),
+                "DELETE FROM messages WHERE thread_id=? AND id <= "
+                "(SELECT id FROM messages WHERE thread_id=? ORDER BY id DESC LIMIT 1 OFFSET ?)",
+                (tid, tid, self.history_per_thread),
             )
-            con.commit()
-            con.close()
-            return False, ""
+        row = con.execute("SELECT MIN(id) AS lo, MAX(id) AS hi FROM messages").fetchone()
+        if row["hi"] is not None and row["hi"] - row["lo"] >= self.history_max_rows:
+            con.execute(
+                "DELETE FROM messages WHERE id IN (SELECT id FROM messages WHERE id <= ? ORDER BY id LIMIT 5000)",
+                (row["hi"] - self.history_max_rows,),
+            )
+        con.commit()
+        return len(rows)
+
+    def thread_messages(self, thread_id: int, limit: int, before_id: Optional[int] = None) -> list[sqlite3.Row]:
+        con = self._con()
+        rows = con.execute(
+            "SELECT id, ts, kind, body, z FROM messages WHERE thread_id=? AND id<? ORDER BY id DESC LIMIT ?",
+            (thread_id, before_id if before_id is not None else 2 ** 63 - 1, limit),
+        ).fetchall()
+        return list(rows)
+
+    def sweep_pending(self, before_ts: int, batch: int) -> int:
+        con = self._con()
+        n = con.execute(
+            "DELETE FROM pending WHERE user_id IN (SELECT user_id FROM pending WHERE created_ts<? LIMIT ?)",
+            (before_ts, batch),
+        ).rowcount
+        con.commit()
+        return n
+
+    def sweep_dead_outbox(self, before_ts: float, batch: int) -> int:
+        con = self._con()
+        n = con.execute(
+            "DELETE FROM outbox WHERE id IN (SELECT id FROM outbox WHERE status='dead' AND next_ts<? LIMIT ?)",
+            (before_ts, batch),
+        ).rowcount
+        con.commit()
+        return n
+
+    def sweep_threads(self, before_ts: int, batch: int) -> int:
+        con = self._con()
+        ids = [(int(r["id"]),) for r in con.execute(
+            "SELECT id FROM threads WHERE updated_ts<? AND unread=0 LIMIT ?", (before_ts, batch)
+        )]
+        con.executemany("DELETE FROM messages WHERE thread_id=?", ids)
+        con.executemany("DELETE FROM threads WHERE id=?", ids)
+        con.commit()
+        return len(ids)
+
+    def sweep_rate_pairs(self, today: str, before_ts: float, batch: int) -> int:
+        con = self._con()
+        n = con.execute(
+            "DELETE FROM rate_pair WHERE rowid IN (SELECT rowid FROM rate_pair WHERE day<? AND last_ts<? LIMIT ?)",
+            (today, before_ts, batch),
+        ).rowcount
+        con.commit()
+        return n
 
-        last_ts = float(row["last_ts"])
-        day = str(row["day"])
-        day_count = int(row["day_count"])
+    def optimize(self, vacuum_pages: int = 256) -> None:
+        con = self._con()
+        con.execute(f"PRAGMA incremental_vacuum({int(vacuum_pages)})").fetchall()
+        con.execute("PRAGMA optimize")
+
+    def add_report(
+        self, thread_id: int, reporter_id: int, sender_id: int, window_sec: int, autoban_threshold: int,
+    ) -> Tuple[bool, int, bool]:
+        con = self._con()
+        now = int(time.time())
+        added = con.execute(
+            "INSERT OR IGNORE INTO reports(thread_id, reporter_id, sender_id, ts) VALUES(?,?,?,?)",
+            (thread_id, reporter_id, sender_id, now),
+        ).rowcount == 1
+        count = int(con.execute(
+            "SELECT COUNT(*) AS c FROM reports WHERE sender_id=? AND ts>=?", (sender_id, now - window_sec)
+        ).fetchone()["c"])
+        con.commit()
+        banned = False
+        if added and 0 < autoban_threshold <= count and not self.access.is_banned(sender_id):
+            self.ban(sender_id)
+            banned = True
+        return added, count, banned
 
-        if now - last_ts < cooldown_sec:
-            con.close()
-            wait = max(1, int(cooldown_sec - (now - last_ts)))
-            return True, f"Слишком часто. Подожди {wait} сек."
+    def report_digest(self, limit: int) -> Tuple[int, list[sqlite3.Row]]:
+        con = self._con()
+        con.execute("BEGIN IMMEDIATE")
+        rows = con.execute(
+            "SELECT sender_id, COUNT(*) AS c, MAX(ts) AS last_ts FROM reports WHERE digested=0 "
+            "GROUP BY sender_id ORDER BY c DESC, last_ts DESC",
+        ).fetchall()
+        con.execute("UPDATE reports SET digested=1 WHERE digested=0")
+        con.commit()
+        return sum(int(r["c"]) for r in rows), list(rows[:limit])
 
-        if day != today:
-            day = today
-            day_count = 0
+    def broadcast_create(self, text: str) -> sqlite3.Row:
+        con = self._con()
+        now = int(time.time())
+        total = int(con.execute("SELECT COUNT(*) AS c FROM users WHERE active=1").fetchone()["c"])
+        row = con.execute(
+            "INSERT INTO broadcasts(text, total, started_ts, updated_ts) VALUES(?,?,?,?) RETURNING *",
+            (text, total, now, now),
+        ).fetchone()
+        con.commit()
+        return row
 
-        if day_count + 1 > daily_limit:
-            con.close()
-            return True, "Дневной лимит на сообщения этому пользователю исчерпан."
+    def broadcasts_running(self) -> list[sqlite3.Row]:
+        con = self._con()
+        return list(con.execute("SELECT * FROM broadcasts WHERE status='running' ORDER BY id").fetchall())
 
+    def broadcast_checkpoint(self, bid: int, cursor: int, sent: int, failed: int, blocked: int, status: str = "running") -> None:
+        con = self._con()
         con.execute(
-            "UPDATE rate_pair SET last_ts=?, day=?, day_count=? WHERE sender_id=? AND recipient_id=?",
-            (now, day, day_count + 1, sender_id, recipient_id),
+            "UPDATE broadcasts SET cursor=?, sent=?, failed=?, blocked=?, status=?, updated_ts=? WHERE id=?",
+            (cursor, sent, failed, blocked, status, int(time.time()), bid),
         )
         con.commit()
-        con.close()
-        return False, ""
 
-    def stats(self) -> Tuple[int, int, int]:
+    def active_users_after(self, after_id: int, limit: int) -> list[int]:
+        con = self._con()
+        rows = con.execute(
+            "SELECT user_id FROM users WHERE user_id>? AND active=1 ORDER BY user_id LIMIT ?", (after_id, limit)
+        ).fetchall()
+        return [int(r["user_id"]) for r in rows]
+
+    def mark_inactive(self, user_ids: list[int]) -> None:
+        con = self._con()
+        con.executemany("UPDATE users SET active=0 WHERE user_id=?", [(u,) for u in user_ids])
+        con.commit()
+
+    def flush_rate(self) -> int:
         con = self._con()
-        users = int(con.execute("SELECT COUNT(*) AS c FROM users").fetchone()["c"])
-        threads = int(con.execute("SELECT COUNT(*) AS c FROM threads").fetchone()["c"])
-        bans = int(con.execute("SELECT COUNT(*) AS c FROM global_bans").fetchone()["c"])
+        n = self.rate.flush(con)
+        con.commit()
+        return n
+
+    def rollback(self) -> None:
+        con = getattr(self._local, "con", None)
+        if con is not None and con.in_transaction:
+            con.rollback()
+
+    def stats(self) -> dict:
+        con = self._con()
+        out = {r["name"]: int(r["value"]) for r in con.execute("SELECT name, value FROM counters")}
+        for pragma in ("page_size", "page_count", "freelist_count"):
+            out[pragma] = int(con.execute(f"PRAGMA {pragma}").fetchone()[0])
+        out["db_bytes"] = out["page_size"] * out["page_count"]
+        try:
+            out["wal_bytes"] = os.path.getsize(self.path + "-wal")
+        except OSError:
+            out["wal_bytes"] = 0
+        return out
+
+
+class MemoryStorage:
+    def __init__(self, rate: Optional[MemoryRateLimiter] = None):
+        self.rate = rate if rate is not None else MemoryRateLimiter()
+        self.access = AccessIndex()
+        self._users: dict[int, list] = {}
+        self._codes: dict[str, int] = {}
+        self._pending: dict[int, int] = {}
+        self._pairs: dict[Tuple[int, int], int] = {}
+        self._threads: list[list] = [[]]
+        self._inbox: dict[int, array] = {}
+        self._lock = threading.Lock()
+
+    def init(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+    def _user(self, user_id: int, default_block_links: int) -> list:
+        u = self._users.get(user_id)
+        if u is None:
+            code = secrets.token_urlsafe(8)
+            u = self._users[user_id] = [code, 1, default_block_links, 0]
+            self._codes[code] = user_id
+        return u
+
+    def ensure_user(self, user_id: int, default_block_links: int) -> str:
+        with self._lock:
+            return self._user(user_id, default_block_links)[0]
+
+    def settings(self, user_id: int, default_block_links: int) -> dict:
+        with self._lock:
+            u = self._user(user_id, default_block_links)
+            return {"anon_enabled": u[1], "block_links": u[2], "code": u[0]}
+
+    def set_anon(self, user_id: int, enabled: bool) -> None:
+        u = self._users.get(user_id)
+        if u is not None:
+            u[1] = 1 if enabled else 0
+
+    def set_block_links(self, user_id: int, enabled: bool) -> None:
+        u = self._users.get(user_id)
+        if u is not None:
+            u[2] = 1 if enabled else 0
+
+    def user_by_code(self, code: str) -> Optional[int]:
+        return self._codes.get(code)
+
+    def is_banned(self, user_id: int) -> bool:
+        return self.access.is_banned(user_id)
+
+    def ban(self, user_id: int) -> None:
+        self.access.ban(user_id)
+
+    def unban(self, user_id: int) -> None:
+        self.access.unban(user_id)
+
+    def is_blocked(self, recipient_id: int, sender_id: int) -> bool:
+        return self.access.is_blocked(recipient_id, sender_id)
+
+    def block(self, recipient_id: int, sender_id: int) -> None:
+        self.access.block(recipient_id, sender_id)
+
+    def set_pending(self, user_id: int, target_user_id: int) -> None:
+        self._pending[user_id] = target_user_id
+
+    def clear_pending(self, user_id: int) -> None:
+        self._pending.pop(user_id, None)
+
+    def pending_target(self, user_id: int) -> Optional[int]:
+        return self._pending.get(user_id)
+
+    def thread_id(self, recipient_id: int, sender_id: int, unread: int = 0) -> int:
+        ts = int(time.time())
+        with self._lock:
+            tid = self._pairs.get((recipient_id, sender_id))
+            if tid is None:
+                tid = self._pairs[(recipient_id, sender_id)] = len(self._threads)
+                self._threads.append([recipient_id, sender_id, ts, unread])
+                self._inbox.setdefault(recipient_id, array("q")).append(tid)
+            else:
+                t = self._threads[tid]
+                t[2] = ts
+                t[3] += unread
+            if unread and recipient_id in self._users:
+                self._users[recipient_id][3] += unread
+        return tid
+
+    def thread_parties(self, thread_id: int) -> Optional[Tuple[int, int]]:
+        if not 0 < thread_id < len(self._threads):
+            return None
+        t = self._threads[thread_id]
+        return t[0], t[1]
+
+    def inbox_threads(self, recipient_id: int, limit: int, before: Optional[Tuple[int, int]] = None) -> list[dict]:
+        with self._lock:
+            tids = self._inbox.get(recipient_id, ())
+            keys = ((self._threads[tid][2], tid) for tid in tids)
+            if before is not None:
+                keys = (k for k in keys if k < before)
+            top = heapq.nlargest(limit, keys)
+            return [
+                {"id": tid, "sender_id": self._threads[tid][1], "updated_ts": ts, "unread": self._threads[tid][3]}
+                for ts, tid in top
+            ]
+
+    def unread_total(self, user_id: int) -> int:
+        u = self._users.get(user_id)
+        return u[3] if u is not None else 0
+
+    def mark_read(self, thread_id: int) -> None:
+        if not 0 < thread_id < len(self._threads):
+            return
+        with self._lock:
+            t = self._threads[thread_id]
+            u = self._users.get(t[0])
+            if u is not None:
+                u[3] = max(0, u[3] - t[3])
+            t[3] = 0
+
+    def rate_check_and_touch(self, sender_id: int, recipient_id: int, cooldown_sec: int, daily_limit: int) -> Tuple[bool, str]:
+        return self.rate.check(None, sender_id, recipient_id, cooldown_sec, daily_limit)
+
+    def counters(self) -> dict:
+        return {
+            "users": len(self._users), "threads": len(self._threads) - 1, "pending": len(self._pending),
+            **{f"index_{k}": v for k, v in self.access.stats().items()},
+        }
+
+
+async def periodic(interval: float, fn) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await fn()
+        except Exception:
+            logging.exception("periodic task %s failed", getattr(fn, "__name__", fn))
+
+
+def online_backup(src_path: str, dst_path: str, pages: int, sleep_sec: float) -> None:
+    src = sqlite3.connect(src_path)
+    dst = sqlite3.connect(dst_path)
+    try:
+        src.execute("BEGIN")
+        src.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchone()
+        src.backup(dst, pages=pages, sleep=sleep_sec, progress=lambda *_: time.sleep(sleep_sec))
+        src.rollback()
+    finally:
+        dst.close()
+        src.close()
+
+
+def check_db(path: str) -> dict:
+    con = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        integrity = con.execute("PRAGMA integrity_check").fetchone()[0]
+        version = int(con.execute("PRAGMA user_version").fetchone()[0])
+        counters = {r[0]: int(r[1]) for r in con.execute("SELECT name, value FROM counters")} if version >= 9 else {}
+    finally:
         con.close()
-        return users, threads, bans
+    ok = integrity == "ok" and 1 <= version <= MIGRATIONS[-1][0]
+    return {"ok": ok, "integrity": integrity, "version": version, "latest": MIGRATIONS[-1][0], **counters}
+
+
+def verify_snapshot(path: str) -> dict:
+    tmp = path + ".verify"
+    try:
+        with gzip.open(path, "rb") as src, open(tmp, "wb") as dst:
+            shutil.copyfileobj(src, dst, 1 << 20)
+        return check_db(tmp)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def restore_snapshot(path: str, db_path: str) -> dict:
+    tmp = db_path + ".restore"
+    with gzip.open(path, "rb") as src, open(tmp, "wb") as dst:
+        shutil.copyfileobj(src, dst, 1 << 20)
+    res = check_db(tmp)
+    if not res["ok"]:
+        os.remove(tmp)
+        raise ValueError(f"snapshot {path} failed verification: {res}")
+    for suffix in ("-wal", "-shm"):
+        if os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
+    os.replace(tmp, db_path)
+    return res
+
+
+class Backups:
+    def __init__(self, db_path: str, directory: str, keep: int, pages: int, sleep_sec: float):
+        self.db_path = db_path
+        self.directory = directory or os.path.join(os.path.dirname(os.path.abspath(db_path)), "backups")
+        self.prefix = os.path.splitext(os.path.basename(db_path))[0]
+        self.keep = keep
+        self.pages = pages
+        self.sleep_sec = sleep_sec
+        self._lock = asyncio.Lock()
+
+    def snapshots(self) -> list[str]:
+        if not os.path.isdir(self.directory):
+            return []
+        names = sorted(n for n in os.listdir(self.directory) if n.startswith(self.prefix + "-") and n.endswith(".db.gz"))
+        return [os.path.join(self.directory, n) for n in names]
+
+    def snapshot(self) -> dict:
+        os.makedirs(self.directory, exist_ok=True)
+        t0 = time.monotonic()
+        base = os.path.join(self.directory, f"{self.prefix}-{datetime.utcnow().strftime('%Y%m%d-%H%M%S')}.db")
+        try:
+            online_backup(self.db_path, base + ".tmp", self.pages, self.sleep_sec)
+            res = check_db(base + ".tmp")
+            if not res["ok"]:
+                raise ValueError(f"backup failed verification: {res}")
+            with open(base + ".tmp", "rb") as src, gzip.open(base + ".gz.tmp", "wb", compresslevel=6) as dst:
+                shutil.copyfileobj(src, dst, 1 << 20)
+            os.replace(base + ".gz.tmp", base + ".gz")
+        finally:
+            for tmp in (base + ".tmp", base + ".gz.tmp"):
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+        old = self.snapshots()[:-self.keep] if self.keep > 0 else []
+        for path in old:
+            os.remove(path)
+        res.update({"path": base + ".gz", "bytes": os.path.getsize(base + ".gz"),
+                    "seconds": round(time.monotonic() - t0, 2), "rotated": len(old)})
+        return res
+
+    async def run(self) -> Optional[dict]:
+        if self._lock.locked():
+            return None
+        async with self._lock:
+            res = await asyncio.to_thread(self.snapshot)
+        logging.info("backup written: %s", res)
+        return res
+
+
+async def sweep(repo: "AsyncRepo", cfg: Config) -> dict:
+    deadline = time.monotonic() + cfg.sweep_budget_sec
+    now = time.time()
+    batch = cfg.sweep_batch
+    steps = {
+        "pending": (lambda: repo.sweep_pending(int(now) - cfg.pending_ttl_sec, batch), batch),
+        "rate_pair": (lambda: repo.sweep_rate_pairs(today_str(), now - MemoryRateLimiter.IDLE_DROP_SEC, batch), batch),
+        "outbox_dead": (lambda: repo.sweep_dead_outbox(now - cfg.outbox_dead_keep_sec, batch), batch),
+    }
+    if cfg.thread_ttl_sec > 0:
+        thread_batch = max(1, batch // 10)
+        steps["threads"] = (lambda: repo.sweep_threads(int(now) - cfg.thread_ttl_sec, thread_batch), thread_batch)
+    done = {}
+    for name, (step, size) in steps.items():
+        done[name] = 0
+        while time.monotonic() < deadline:
+            n = await step()
+            done[name] += n
+            if n < size:
+                break
+            await asyncio.sleep(0)
+    await repo.optimize()
+    if any(done.values()):
+        logging.info("sweep removed %s", done)
+    return done
+
+
+class AsyncRepo:
+    WRITES = frozenset({
+        "init", "ban", "unban", "ensure_user", "set_anon", "set_block_links", "block",
+        "set_pending", "clear_pending", "thread_id", "rate_check_and_touch", "admit_delivery", "flush_rate",
+        "outbox_claim", "outbox_done", "outbox_fail", "mark_read", "flush_messages",
+        "sweep_pending", "sweep_rate_pairs", "sweep_dead_outbox", "sweep_threads", "optimize", "add_report", "report_digest",
+        "broadcast_create", "broadcast_checkpoint", "mark_inactive",
+    })
+    INLINE = frozenset({"is_banned", "is_blocked", "counters", "log_message"})
+
+    def __init__(self, repo: Repo, readers: int = 4, metrics: Optional[Metrics] = None):
+        self.repo = repo
+        self.metrics = metrics or Metrics()
+        self._readers = concurrent.futures.ThreadPoolExecutor(max_workers=readers, thread_name_prefix="repo-read")
+        self._writes: queue.Queue = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, name="repo-write", daemon=True)
+        self._writer.start()
+
+    def _write_loop(self) -> None:
+        while True:
+            item = self._writes.get()
+            if item is None:
+                return
+            fut, fn = item
+            if not fut.set_running_or_notify_cancel():
+                continue
+            try:
+                fut.set_result(fn())
+            except BaseException as e:
+                try:
+                    self.repo.rollback()
+                except sqlite3.Error:
+                    logging.exception("writer rollback failed")
+                fut.set_exception(e)
+
+    def _submit_write(self, fn) -> asyncio.Future:
+        fut: concurrent.futures.Future = concurrent.futures.Future()
+        self._writes.put((fut, fn))
+        return asyncio.wrap_future(fut)
+
+    async def settings(self, user_id: int, default_block_links: int) -> dict:
+        s = await self.user_settings(user_id)
+        if s is None:
+            code = await self.ensure_user(user_id, default_block_links)
+            s = {"anon_enabled": 1, "block_links": default_block_links, "code": code}
+        return s
+
+    def __getattr__(self, name: str):
+        fn = getattr(self.repo, name)
+        if not callable(fn) or name.startswith("_"):
+            return fn
+
+        if name in self.INLINE:
+            async def call(*args, **kwargs):
+                return fn(*args, **kwargs)
+        elif name in self.WRITES:
+            async def call(*args, **kwargs):
+                return await self._submit_write(functools.partial(fn, *args, **kwargs))
+        else:
+            async def call(*args, **kwargs):
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(self._readers, functools.partial(fn, *args, **kwargs))
+
+        call = self.metrics.timed("repo_call_seconds", f'method="{name}"')(call)
+        setattr(self, name, call)
+        return call
+
+    def close(self) -> None:
+        self._writes.put(None)
+        self._writer.join()
+        self._readers.shutdown(wait=True)
+        self.repo.close()
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.ts = time.monotonic()
+
+    def take(self) -> float:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.ts) * self.rate)
+        self.ts = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def idle(self) -> bool:
+        return self.tokens + (time.monotonic() - self.ts) * self.rate >= self.burst
+
+
+PRIO_USER = 0
+PRIO_BULK = 1
+
+
+class FloodGate(BaseRequestMiddleware):
+    LIMITED = ("send", "copy", "forward", "edit")
+
+    def __init__(self, rate: float):
+        self.bucket = TokenBucket(rate, rate)
+        self.paused_until = 0.0
+        self.pauses = 0
+
+    def pause(self, sec: float) -> None:
+        until = time.monotonic() + sec
+        if until > self.paused_until:
+            self.paused_until = until
+            self.pauses += 1
+            logging.warning("flood control: pausing sends for %.1f s", sec)
+
+    async def __call__(self, make_request, bot, method):
+        if method.__api_method__.startswith(self.LIMITED):
+            while (delay := self.paused_until - time.monotonic()) > 0:
+                await asyncio.sleep(delay)
+            while (delay := self.bucket.take()) > 0:
+                await asyncio.sleep(delay)
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter as e:
+            self.pause(float(e.retry_after))
+            raise
+
+
+class SendQueue:
+    MAX_BACKOFF_SEC = 30.0
+
+    def __init__(self, workers: int = 8, global_rate: float = 30.0, chat_rate: float = 1.0, max_retries: int = 5):
+        self.workers = workers
+        self.chat_rate = chat_rate
+        self.max_retries = max_retries
+        self.gate = FloodGate(global_rate)
+        self._chats: dict[int, TokenBucket] = {}
+        self._backlog: dict[int, list] = {}
+        self._queue: asyncio.PriorityQueue = asyncio.PriorityQueue()
+        self._seq = 0
+        self._tasks: list[asyncio.Task] = []
+        self._latency: deque = deque(maxlen=1000)
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+
+    def start(self) -> None:
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def close(self) -> None:
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, chat_id: int, call: Callable[[], Awaitable], priority: int = PRIO_USER) -> asyncio.Future:
+        fut = asyncio.get_running_loop().create_future()
+        fut.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._put(priority, [chat_id, call, time.monotonic(), 0, fut, TRACE_ID.get(), False])
+        return fut
+
+    def _put(self, priority: int, job: list) -> None:
+        self._seq += 1
+        self._queue.put_nowait((priority, self._seq, job))
+
+    async def _retry_later(self, priority: int, job: list, delay: float) -> None:
+        await asyncio.sleep(delay)
+        self._put(priority, job)
+
+    def _bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 10000:
+                self._chats = {k: b for k, b in self._chats.items() if k in self._backlog or not b.idle()}
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, 1)
+        return bucket
+
+    def _admit(self, item: tuple) -> bool:
+        job = item[2]
+        if job[6]:
+            job[6] = False
+            return True
+        chat_id = job[0]
+        backlog = self._backlog.get(chat_id)
+        if backlog is not None:
+            heapq.heappush(backlog, item)
+            return False
+        delay = self._bucket(chat_id).take()
+        if delay <= 0:
+            return True
+        self._backlog[chat_id] = [item]
+        asyncio.get_running_loop().call_later(delay, self._release, chat_id)
+        return False
+
+    def _release(self, chat_id: int) -> None:
+        backlog = self._backlog[chat_id]
+        while backlog and backlog[0][2][4].done():
+            heapq.heappop(backlog)
+        if not backlog:
+            del self._backlog[chat_id]
+            return
+        loop = asyncio.get_running_loop()
+        delay = self._bucket(chat_id).take()
+        if delay > 0:
+            loop.call_later(delay, self._release, chat_id)
+            return
+        item = heapq.heappop(backlog)
+        item[2][6] = True
+        self._queue.put_nowait(item)
+        if backlog:
+            loop.call_later(1.0 / self.chat_rate, self._release, chat_id)
+        else:
+            del self._backlog[chat_id]
+
+    async def _worker(self) -> None:
+        while True:
+            item = await self._queue.get()
+            priority, _, job = item
+            chat_id, call, enqueued, attempt, fut, trace_id, _ = job
+            if fut.done() or not self._admit(item):
+                continue
+            TRACE_ID.set(trace_id)
+            try:
+                res = await call()
+            except TelegramRetryAfter as e:
+                delay = float(e.retry_after)
+            except (TelegramNetworkError, TelegramServerError):
+                delay = min(self.MAX_BACKOFF_SEC, 2.0 ** attempt)
+            except Exception as e:
+                self.failed += 1
+                logging.warning("send to %s failed: %r", chat_id, e)
+                fut.set_exception(e)
+                continue
+            else:
+                self.sent += 1
+                self._latency.append(time.monotonic() - enqueued)
+                fut.set_result(res)
+                continue
+
+            if attempt + 1 > self.max_retries:
+                self.failed += 1
+                logging.warning("send to %s dropped after %s attempts", chat_id, attempt + 1)
+                fut.set_exception(RuntimeError(f"send to {chat_id} failed after {attempt + 1} attempts"))
+                continue
+            self.retries += 1
+            job[3] = attempt + 1
+            asyncio.create_task(self._retry_later(priority, job, delay))
+
+    def stats(self) -> dict:
+        lat = sorted(self._latency)
+        p50 = lat[len(lat) // 2] if lat else 0.0
+        p99 = lat[min(len(lat) - 1, int(len(lat) * 0.99))] if lat else 0.0
+        return {
+            "depth": self._queue.qsize() + sum(len(b) for b in self._backlog.values()),
+            "waiting_chats": len(self._backlog), "flood_pauses": self.gate.pauses,
+            "sent": self.sent, "failed": self.failed, "retries": self.retries, "p50_ms": int(p50 * 1000), "p99_ms": int(p99 * 1000),
+        }
+
+
+class OutboxWorker:
+    def __init__(self, repo: AsyncRepo, bot: Bot, outbound: SendQueue, batch: int, max_inflight: int, max_attempts: int):
+        self.repo = repo
+        self.bot = bot
+        self.outbound = outbound
+        self.batch = batch
+        self.max_inflight = max_inflight
+        self.max_attempts = max_attempts
+        self.wake = asyncio.Event()
+        self.dead = 0
+        self._inflight = 0
+        self._results: list[Tuple[int, Optional[BaseException]]] = []
+
+    def _send(self, r: sqlite3.Row) -> None:
+        chat_id = int(r["chat_id"])
+        payload = json.loads(r["payload"])
+        markup = kb_inbound(int(r["thread_id"]), int(r["sender_id"])).as_markup()
+        fut = self.outbound.submit(chat_id, lambda: send_payload(self.bot, chat_id, payload, markup))
+        self._inflight += 1
+        fut.add_done_callback(functools.partial(self._on_done, int(r["id"])))
+
+    def _on_done(self, oid: int, fut: asyncio.Future) -> None:
+        err = asyncio.CancelledError() if fut.cancelled() else fut.exception()
+        self._results.append((oid, err))
+        self._inflight -= 1
+        self.wake.set()
+
+    async def _settle(self) -> None:
+        results, self._results = self._results, []
+        done = [oid for oid, err in results if err is None]
+        failed = [
+            (oid, isinstance(err, (TelegramForbiddenError, TelegramBadRequest)), repr(err))
+            for oid, err in results if err is not None and not isinstance(err, asyncio.CancelledError)
+        ]
+        if done:
+            await self.repo.outbox_done(done)
+        if failed:
+            dead = await self.repo.outbox_fail(failed, self.max_attempts)
+            if dead:
+                self.dead += dead
+                logging.warning("outbox: %s message(s) dead-lettered, last error %s", dead, failed[-1][2])
+
+    async def run(self) -> None:
+        while True:
+            await self._settle()
+            room = self.max_inflight - self._inflight
+            rows = await self.repo.outbox_claim(min(self.batch, room)) if room > 0 else []
+            for r in rows:
+                self._send(r)
+            if len(rows) < self.batch:
+                waiter = asyncio.ensure_future(self.wake.wait())
+                try:
+                    await asyncio.wait((waiter,), timeout=1.0)
+                finally:
+                    waiter.cancel()
+                self.wake.clear()
+
+
+HISTORY_KINDS = {
+    "photo": "🖼 Фото", "video": "🎬 Видео", "voice": "🎤 Голосовое",
+    "video_note": "⏺ Кружок", "document": "📄 Файл", "album": "🖼 Альбом", "empty": "📩",
+}
+
+
+def format_history_line(r: sqlite3.Row, width: int = 300) -> str:
+    when = datetime.utcfromtimestamp(int(r["ts"])).strftime("%d.%m %H:%M")
+    text = unpack_text(r["body"], int(r["z"]))
+    if len(text) > width:
+        text = text[:width] + "…"
+    kind = HISTORY_KINDS.get(str(r["kind"]))
+    if kind:
+        text = f"{kind} {text}".rstrip()
+    return f"[{when}] {text}"
 
 
 def kb_main(settings: dict) -> InlineKeyboardBuilder:
@@ -345,97 +2273,616 @@ def kb_inbound(thread_id: int, sender_id: int) -> InlineKeyboardBuilder:
     return kb
 
 
-def kb_inbox_list(threads: Iterable[sqlite3.Row]) -> InlineKeyboardBuilder:
+def kb_inbox_list(threads: Iterable[sqlite3.Row], next_cursor: str = "", first_page: bool = True) -> InlineKeyboardBuilder:
     kb = InlineKeyboardBuilder()
     for r in threads:
         tid = int(r["id"])
-        kb.button(text=f"💬 Диалог #{tid}", callback_data=f"inbox:{tid}")
+        unread = int(r["unread"])
+        kb.button(text=f"💬 Диалог #{tid}" + (f" ({unread})" if unread else ""), callback_data=f"inbox:{tid}")
+    if not first_page:
+        kb.button(text="⏮ В начало", callback_data="ui:inbox")
+    if next_cursor:
+        kb.button(text="➡️ Дальше", callback_data=f"inboxp:{next_cursor}")
     kb.adjust(1)
     return kb
 
 
-async def run_bot(cfg: Config) -> None:
-    repo = Repo(cfg.db_path)
-    repo.init()
+def message_payload(msg: Message) -> dict:
+    if msg.text:
+        return {"kind": "text", "text": msg.text}
+    if msg.photo:
+        return {"kind": "photo", "file_id": msg.photo[-1].file_id, "caption": msg.caption}
+    if msg.video:
+        return {"kind": "video", "file_id": msg.video.file_id, "caption": msg.caption}
+    if msg.voice:
+        return {"kind": "voice", "file_id": msg.voice.file_id, "caption": msg.caption}
+    if msg.video_note:
+        return {"kind": "video_note", "file_id": msg.video_note.file_id}
+    if msg.document:
+        return {"kind": "document", "file_id": msg.document.file_id, "caption": msg.caption}
+    return {"kind": "empty"}
+
+
+ALBUM_MEDIA = {"photo": InputMediaPhoto, "video": InputMediaVideo, "document": InputMediaDocument}
+
+
+def album_payload(msgs: list[Message]) -> dict:
+    items = []
+    for m in msgs[:10]:
+        p = message_payload(m)
+        if p["kind"] in ALBUM_MEDIA:
+            items.append({"kind": p["kind"], "file_id": p["file_id"], "caption": p.get("caption")})
+    caption = next((i["caption"] for i in items if i["caption"]), None)
+    return {"kind": "album", "items": items, "caption": caption}
+
+
+async def send_album(bot: Bot, chat_id: int, p: dict, reply_markup=None):
+    items = p["items"]
+    media = [
+        ALBUM_MEDIA[i["kind"]](
+            media=i["file_id"],
+            caption=(i["caption"] or ("📩 Анонимное сообщение" if n == 0 and not p.get("caption") else None)),
+        )
+        for n, i in enumerate(items)
+    ]
+    sent = await bot.send_media_group(chat_id, media)
+    await bot.send_message(chat_id, "📩 Анонимный альбом", reply_markup=reply_markup)
+    return sent
+
+
+def send_payload(bot: Bot, chat_id: int, p: dict, reply_markup=None) -> Awaitable:
+    kind = p["kind"]
+    if kind == "album":
+        return send_album(bot, chat_id, p, reply_markup)
+    caption = p.get("caption") or "📩 Анонимное сообщение"
+    if kind == "text":
+        return bot.send_message(chat_id, f"📩 Анонимное сообщение:\n\n{p['text']}", reply_markup=reply_markup)
+    if kind == "photo":
+        return bot.send_photo(chat_id, p["file_id"], caption=caption, reply_markup=reply_markup)
+    if kind == "video":
+        return bot.send_video(chat_id, p["file_id"], caption=caption, reply_markup=reply_markup)
+    if kind == "voice":
+        return bot.send_voice(chat_id, p["file_id"], caption=caption, reply_markup=reply_markup)
+    if kind == "video_note":
+        return bot.send_video_note(chat_id, p["file_id"], reply_markup=reply_markup)
+    if kind == "document":
+        return bot.send_document(chat_id, p["file_id"], caption=caption, reply_markup=reply_markup)
+    return bot.send_message(chat_id, "📩 Анонимное сообщение", reply_markup=reply_markup)
+
+
+class AlbumCollector:
+    def __init__(self, delay: float, flush: Callable[[int, int, list[Message]], Awaitable]):
+        self.delay = delay
+        self.flush = flush
+        self._groups: dict[Tuple[int, str], list] = {}
+        self._tasks: dict[asyncio.Task, int] = {}
+
+    def target(self, sender_id: int, group_id: str) -> Optional[int]:
+        g = self._groups.get((sender_id, group_id))
+        return g[0] if g else None
+
+    def add(self, sender_id: int, target: int, msg: Message) -> None:
+        key = (sender_id, msg.media_group_id)
+        g = self._groups.get(key)
+        if g is None:
+            g = self._groups[key] = [target, [], None]
+        g[1].append(msg)
+        if g[2] is not None:
+            g[2].cancel()
+        g[2] = asyncio.get_running_loop().call_later(self.delay, self._fire, key)
+
+    def _fire(self, key: Tuple[int, str]) -> None:
+        target, msgs, timer = self._groups.pop(key)
+        timer.cancel()
+        msgs.sort(key=lambda m: m.message_id)
+        task = asyncio.create_task(self._run(key[0], target, msgs))
+        self._tasks[task] = key[0]
+        task.add_done_callback(lambda t: self._tasks.pop(t, None))
+
+    async def settle(self, sender_id: int, group_id: Optional[str] = None) -> None:
+        for key in [k for k in self._groups if k[0] == sender_id and k[1] != group_id]:
+            self._fire(key)
+        running = [t for t, sid in self._tasks.items() if sid == sender_id]
+        if running:
+            await asyncio.gather(*running)
+
+    async def _run(self, sender_id: int, target: int, msgs: list[Message]) -> None:
+        try:
+            await self.flush(sender_id, target, msgs)
+        except Exception:
+            logging.exception("album delivery failed")
+
+
+class Broadcaster:
+    def __init__(self, repo: AsyncRepo, bot: Bot, outbound: SendQueue, admin_id: int, page: int, report_sec: float):
+        self.repo = repo
+        self.bot = bot
+        self.outbound = outbound
+        self.admin_id = admin_id
+        self.page = page
+        self.report_sec = report_sec
+        self._tasks: dict[int, asyncio.Task] = {}
+        self._cancelled: set[int] = set()
+
+    def start(self, row: sqlite3.Row) -> None:
+        bid = int(row["id"])
+        self._tasks[bid] = asyncio.create_task(self._run(row))
+        self._tasks[bid].add_done_callback(lambda _: self._tasks.pop(bid, None))
+
+    def cancel(self, bid: int) -> bool:
+        task = self._tasks.get(bid)
+        if task is None:
+            return False
+        self._cancelled.add(bid)
+        task.cancel()
+        return True
+
+    async def close(self) -> None:
+        tasks = list(self._tasks.values())
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _report(self, text: str) -> None:
+        if self.admin_id > 0:
+            self.outbound.submit(self.admin_id, lambda: self.bot.send_message(self.admin_id, text), PRIO_USER)
+
+    async def _run(self, row: sqlite3.Row) -> None:
+        bid, text, total = int(row["id"]), str(row["text"]), int(row["total"])
+        cursor, sent, failed, blocked = int(row["cursor"]), int(row["sent"]), int(row["failed"]), int(row["blocked"])
+        started = time.monotonic()
+        done_here = 0
+        last_report = started
+        try:
+            while True:
+                ids = await self.repo.active_users_after(cursor, self.page)
+                if not ids:
+                    break
+                futs = [
+                    self.outbound.submit(uid, functools.partial(self.bot.send_message, uid, text), PRIO_BULK)
+                    for uid in ids
+                ]
+                results = await asyncio.gather(*futs, return_exceptions=True)
+                gone = [uid for uid, r in zip(ids, results) if isinstance(r, TelegramForbiddenError)]
+                errors = sum(1 for r in results if isinstance(r, BaseException))
+                sent += len(ids) - errors
+                failed += errors - len(gone)
+                blocked += len(gone)
+                done_here += len(ids)
+                if gone:
+                    await self.repo.mark_inactive(gone)
+                cursor = ids[-1]
+                await self.repo.broadcast_checkpoint(bid, cursor, sent, failed, blocked)
+                now = time.monotonic()
+                if now - last_report >= self.report_sec:
+                    last_report = now
+                    rate = done_here / max(now - started, 1e-6)
+                    left = max(0, total - sent - failed - blocked)
+                    self._report(
+                        f"📣 Рассылка #{bid}: {sent + failed + blocked}/{total}, "
+                        f"{rate:.1f} сообщ./с, осталось ~{int(left / rate) if rate else 0} с"
+                    )
+        except asyncio.CancelledError:
+            if bid in self._cancelled:
+                self._cancelled.discard(bid)
+                await self.repo.broadcast_checkpoint(bid, cursor, sent, failed, blocked, "cancelled")
+            raise
+        await self.repo.broadcast_checkpoint(bid, cursor, sent, failed, blocked, "done")
+        elapsed = time.monotonic() - started
+        self._report(
+            f"✅ Рассылка #{bid} завершена: отправлено {sent}, ошибок {failed}, заблокировали бота {blocked}, "
+            f"{done_here / max(elapsed, 1e-6):.1f} сообщ./с"
+        )
 
-    bot = Bot(cfg.token)
+
+class HandlerTimer(BaseMiddleware):
+    def __init__(self, metrics: Metrics):
+        self.metrics = metrics
+
+    async def __call__(self, handler, event, data):
+        h = data.get("handler")
+        name = h.callback.__name__ if h is not None else "unknown"
+        t0 = time.perf_counter()
+        error = True
+        try:
+            res = await handler(event, data)
+            error = False
+            return res
+        finally:
+            self.metrics.record("handler_seconds", f'handler="{name}"', name, t0, error)
+
+
+class ApiTimer(BaseRequestMiddleware):
+    def __init__(self, metrics: Metrics):
+        self.metrics = metrics
+
+    async def __call__(self, make_request, bot, method):
+        t0 = time.perf_counter()
+        error = True
+        try:
+            res = await make_request(bot, method)
+            error = False
+            return res
+        finally:
+            name = method.__api_method__
+            self.metrics.record("api_call_seconds", f'method="{name}"', name, t0, error)
+
+
+class MetricsServer:
+    def __init__(self, metrics: Metrics, host: str, port: int):
+        self.metrics = metrics
+        self.host = host
+        self.port = port
+        self._runner: Optional[web.AppRunner] = None
+
+    async def handle(self, request: web.Request) -> web.Response:
+        return web.Response(
+            body=self.metrics.render().encode(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+        )
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logging.info("Metrics on http://%s:%s/metrics", self.host, self.port)
+
+    async def close(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+class UpdateRecorder(BaseMiddleware):
+    FLUSH_SEC = 1.0
+    KEEP_KEYS = frozenset({
+        "update_id", "message_id", "date", "edit_date", "media_group_id", "chat_instance", "type", "offset", "length",
+        "width", "height", "duration", "file_size", "mime_type",
+    })
+    NESTED_KEYS = frozenset({
+        "message", "edited_message", "callback_query", "reply_to_message", "forward_origin", "entities",
+        "caption_entities", "photo", "video", "voice", "video_note", "document", "animation", "thumbnail",
+    })
+    PARTY_KEYS = frozenset({"from", "chat", "sender_chat", "user", "sender_user", "forward_from", "forward_from_chat", "via_bot"})
+    PARTY_NAMES = frozenset({"first_name", "title"})
+    NAME_KEYS = frozenset({"sender_user_name", "author_signature"})
+    TEXT_KEYS = frozenset({"text", "caption"})
+    FILE_KEYS = frozenset({"file_id", "file_unique_id"})
+    THREAD_DATA = re.compile(r"^(reply|report|inbox|hist):(\d+)(.*)$")
+    NON_SPACE = re.compile(r"\S")
+
+    def __init__(self, path: str, salt: str, repo: AsyncRepo, admin_id: int):
+        self.path = path
+        self.repo = repo
+        self._salt = (salt or secrets.token_hex(16)).encode()
+        self._buf: list[str] = [json.dumps({"recorder": 1, "admin_id": self.hash_id(admin_id)})]
+        self.recorded = 0
+
+    def hash_id(self, value) -> int:
+        digest = hmac.new(self._salt, str(value).encode(), hashlib.sha256).digest()
+        return int.from_bytes(digest[:6], "big") + 1
+
+    def _redact(self, text: str) -> str:
+        return self.NON_SPACE.sub(lambda m: "xx" if ord(m.group()) > 0xFFFF else "x", text)
+
+    def _scrub_text(self, text: str) -> str:
+        if not text.startswith("/"):
+            return self._redact(text)
+        cmd, _, arg = text.partition(" ")
+        if not arg:
+            return cmd
+        if arg.isdigit():
+            return f"{cmd} {self.hash_id(int(arg))}"
+        return f"{cmd} {self._redact(arg)}"
+
+    def _party(self, obj: dict) -> dict:
+        out = {"id": self.hash_id(obj.get("id"))}
+        for k, v in obj.items():
+            if k in ("type", "is_bot"):
+                out[k] = v
+            elif k in self.PARTY_NAMES:
+                out[k] = "u"
+        return out
+
+    def _scrub(self, obj):
+        if isinstance(obj, list):
+            return [self._scrub(x) for x in obj if isinstance(x, dict)]
+        out = {}
+        for k, v in obj.items():
+            if k in self.KEEP_KEYS and not isinstance(v, (dict, list)):
+                out[k] = v
+            elif k in self.PARTY_KEYS and isinstance(v, dict):
+                out[k] = self._party(v)
+            elif k in self.NESTED_KEYS and isinstance(v, (dict, list)):
+                out[k] = self._scrub(v)
+            elif k in self.TEXT_KEYS and isinstance(v, str):
+                out[k] = self._scrub_text(v)
+            elif k in self.NAME_KEYS and isinstance(v, str):
+                out[k] = "u"
+            elif k in self.FILE_KEYS:
+                out[k] = f"f{self.hash_id(v)}"
+            elif k == "url":
+                out[k] = "https://example.com"
+            elif k == "id":
+                out[k] = str(self.hash_id(v))
+            elif k == "data":
+                out[k] = "?"
+        return out
+
+    async def _thread_ref(self, data: str) -> str:
+        m = self.THREAD_DATA.match(data)
+        if m:
+            parties = await self.repo.thread_parties(int(m.group(2)))
+            if not parties:
+                return f"{m.group(1)}:?"
+            return f"{m.group(1)}:@{self.hash_id(parties[0])}.{self.hash_id(parties[1])}{m.group(3)}"
+        if data.startswith("block:") and data[6:].isdigit():
+            return f"block:{self.hash_id(int(data[6:]))}"
+        if data.startswith("ui:"):
+            return data
+        return data.split(":", 1)[0] + ":?"
+
+    async def anonymize(self, update) -> dict:
+        raw = update.model_dump(mode="json", by_alias=True, exclude_none=True)
+        out = self._scrub(raw)
+        text = update.message.text if update.message else None
+        if text and text.startswith("/start u_"):
+            owner = await self.repo.user_by_code(text.split(maxsplit=1)[1][2:])
+            out["message"]["text"] = f"/start u_@{self.hash_id(owner)}" if owner else "/start u_?"
+        if update.callback_query and update.callback_query.data:
+            out["callback_query"]["data"] = await self._thread_ref(update.callback_query.data)
+        return out
+
+    async def __call__(self, handler, event, data):
+        try:
+            rec = {"ts": round(time.time(), 3), "update": await self.anonymize(event)}
+            self._buf.append(json.dumps(rec, ensure_ascii=False))
+            self.recorded += 1
+        except Exception:
+            logging.exception("update recording failed")
+        return await handler(event, data)
+
+    def _write(self, lines: list[str]) -> None:
+        with gzip.open(self.path, "at", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+
+    async def flush(self) -> None:
+        if not self._buf:
+            return
+        lines, self._buf = self._buf, []
+        await asyncio.to_thread(self._write, lines)
+
+
+class UserSerializer(BaseMiddleware):
+    def __init__(self, max_running: int):
+        self._locks: dict[int, list] = {}
+        self._slots = asyncio.Semaphore(max_running)
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is None:
+            async with self._slots:
+                return await handler(event, data)
+        entry = self._locks.get(user.id)
+        if entry is None:
+            entry = self._locks[user.id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0], self._slots:
+                return await handler(event, data)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[user.id]
+
+
+class WebhookServer:
+    def __init__(self, cfg: Config, bot: Bot, dp: Dispatcher):
+        self.cfg = cfg
+        self.bot = bot
+        self.dp = dp
+        self.secret = cfg.webhook_secret or secrets.token_urlsafe(32)
+        self._pending = asyncio.Semaphore(cfg.max_pending_updates)
+        self._tasks: set[asyncio.Task] = set()
+        self.app = web.Application()
+        self.app.router.add_post(cfg.webhook_path, self.handle)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if not secrets.compare_digest(request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), self.secret):
+            return web.Response(status=401)
+        try:
+            update = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        await self._pending.acquire()
+        task = asyncio.create_task(self._process(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return web.Response()
+
+    async def _process(self, update: dict) -> None:
+        try:
+            await self.dp.feed_raw_update(self.bot, update)
+        except Exception:
+            logging.exception("update processing failed")
+        finally:
+            self._pending.release()
+
+    async def run(self) -> None:
+        runner = web.AppRunner(self.app)
+        await runner.setup()
+        site = web.TCPSite(runner, self.cfg.webhook_host, self.cfg.webhook_port)
+        await self.dp.emit_startup(bot=self.bot, dispatcher=self.dp)
+        try:
+            await site.start()
+            await self.bot.set_webhook(
+                self.cfg.webhook_url + self.cfg.webhook_path,
+                secret_token=self.secret,
+                drop_pending_updates=True,
+            )
+            logging.info("Webhook listening on %s:%s", self.cfg.webhook_host, self.cfg.webhook_port)
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+            await self.dp.emit_shutdown(bot=self.bot, dispatcher=self.dp)
+            await self.bot.session.close()
+
+
+def build_dispatcher(cfg: Config, bot: Bot, repo: AsyncRepo) -> Dispatcher:
     dp = Dispatcher()
+    tracer = Tracer(cfg.trace_path) if cfg.trace_path else None
+    if tracer is not None:
+        repo.metrics.tracer = tracer
+        dp.update.outer_middleware(tracer)
+    dp.update.outer_middleware(UserSerializer(cfg.max_concurrent_updates))
+    recorder = UpdateRecorder(cfg.record_path, cfg.record_salt, repo, cfg.admin_id) if cfg.record_path else None
+    if recorder is not None:
+        dp.update.outer_middleware(recorder)
+    metrics = repo.metrics
+    dp.message.middleware(HandlerTimer(metrics))
+    dp.callback_query.middleware(HandlerTimer(metrics))
+    outbound = SendQueue(cfg.send_workers, cfg.send_global_rate, cfg.send_chat_rate, cfg.send_max_retries)
+    bot.session.middleware(outbound.gate)
+    bot.session.middleware(ApiTimer(metrics))
+    metrics_server = MetricsServer(metrics, cfg.metrics_host, cfg.metrics_port)
+    outbox = OutboxWorker(repo, bot, outbound, cfg.outbox_batch, cfg.outbox_max_inflight, cfg.outbox_max_attempts)
+    guard = SenderGuard(
+        cfg.sender_window_sec, cfg.sender_max_per_window,
+        cfg.fanout_window_sec, cfg.fanout_max_recipients, cfg.fanout_policy,
+    )
+    content_filter = ContentFilter(cfg.filter_rules_path, cfg.filter_reload_sec)
+    autobanned: list[int] = []
+    received = EventRate()
+    delivered = EventRate()
+    rejected: Counter = Counter()
+    metrics.collect(lambda: {
+        "messages_received_total": received.total,
+        "messages_delivered_total": delivered.total,
+        "outbox_dead_lettered_total": outbox.dead,
+        **{f'rejected_total{{reason="{k}"}}': v for k, v in rejected.items()},
+        **{f"db_{k}": v for k, v in repo.repo.counters().items()},
+        **{f"send_{k}": v for k, v in outbound.stats().items()},
+        **{f"guard_{k}": v for k, v in guard.stats().items()},
+    })
+    backups = Backups(cfg.db_path, cfg.backup_dir, cfg.backup_keep, cfg.backup_pages, cfg.backup_sleep_sec)
+    broadcaster = Broadcaster(repo, bot, outbound, cfg.admin_id, cfg.broadcast_page, cfg.broadcast_report_sec)
+    tasks: list[asyncio.Task] = []
+
+    async def send_report_digest() -> None:
+        total, rows = await repo.report_digest(20)
+        if not rows or cfg.admin_id <= 0:
+            return
+        lines = [f"📋 Жалобы за период: {total}", ""]
+        for r in rows:
+            sid = int(r["sender_id"])
+            lines.append(f"sender_id={sid} — {int(r['c'])} шт. /ban {sid}")
+        if autobanned:
+            lines.append("")
+            lines.append("Автобан: " + ", ".join(str(u) for u in autobanned))
+            autobanned.clear()
+        text = "\n".join(lines)
+        outbound.submit(cfg.admin_id, lambda: bot.send_message(cfg.admin_id, text), PRIO_BULK)
+
+    async def on_startup() -> None:
+        if cfg.metrics_port:
+            await metrics_server.start()
+        outbound.start()
+        tasks.append(asyncio.create_task(periodic(cfg.rate_flush_sec, repo.flush_rate)))
+        tasks.append(asyncio.create_task(periodic(cfg.history_flush_sec, repo.flush_messages)))
+        tasks.append(asyncio.create_task(periodic(cfg.sweep_interval_sec, functools.partial(sweep, repo, cfg))))
+        tasks.append(asyncio.create_task(periodic(cfg.report_digest_sec, send_report_digest)))
+        tasks.append(asyncio.create_task(outbox.run()))
+        if recorder is not None:
+            tasks.append(asyncio.create_task(periodic(recorder.FLUSH_SEC, recorder.flush)))
+        if tracer is not None:
+            tasks.append(asyncio.create_task(periodic(tracer.FLUSH_SEC, tracer.flush)))
+        if cfg.backup_interval_sec > 0:
+            tasks.append(asyncio.create_task(periodic(cfg.backup_interval_sec, backups.run)))
+        for row in await repo.broadcasts_running():
+            logging.info("resuming broadcast #%s from user_id>%s", row["id"], row["cursor"])
+            broadcaster.start(row)
+
+    async def on_shutdown() -> None:
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        tasks.clear()
+        await broadcaster.close()
+        await outbound.close()
+        await repo.flush_rate()
+        await repo.flush_messages()
+        if recorder is not None:
+            await recorder.flush()
+        if tracer is not None:
+            await tracer.flush()
+        await metrics_server.close()
+
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
 
     async def me_username() -> str:
         me = await bot.get_me()
         return me.username or ""
 
     async def render_home(user_id: int) -> Tuple[str, InlineKeyboardBuilder]:
-        s = repo.settings(user_id, cfg.default_block_links)
+        s = await repo.settings(user_id, cfg.default_block_links)
         username = await me_username()
         link = f"https://t.me/{username}?start=u_{s['code']}"
         return link, kb_main(s)
 
-    async def deliver(sender_id: int, recipient_id: int, msg: Message) -> None:
-        if repo.is_banned(sender_id):
-            await msg.answer("Доступ ограничен.")
-            return
-
-        if repo.is_banned(recipient_id) or repo.is_blocked(recipient_id, sender_id):
-            repo.clear_pending(sender_id)
-            await msg.answer("Сообщение не доставлено.")
+    def flag_sender(sender_id: int, recipients: int) -> None:
+        if cfg.admin_id <= 0:
             return
+        text = f"🚩 Подозрение на рассылку\nsender_id={sender_id}\nполучателей≈{recipients}\n/ban {sender_id}"
+        outbound.submit(cfg.admin_id, lambda: bot.send_message(cfg.admin_id, text), PRIO_BULK)
 
-        rs = repo.settings(recipient_id, cfg.default_block_links)
-        if rs["anon_enabled"] == 0:
-            repo.clear_pending(sender_id)
-            await msg.answer("У пользователя отключены анонимные сообщения.")
-            return
+    async def deliver(sender_id: int, recipient_id: int, msg: Message) -> None:
+        await deliver_parts(sender_id, recipient_id, [msg])
 
-        limited, reason = repo.rate_check_and_touch(
-            sender_id, recipient_id, cfg.cooldown_sec, cfg.daily_limit_per_pair
-        )
+    @metrics.timed("handler_seconds", 'handler="deliver"')
+    async def deliver_parts(sender_id: int, recipient_id: int, msgs: list[Message]) -> None:
+        msg = msgs[-1]
+        received.add()
+        limited, reason = guard.check_message(sender_id)
         if limited:
+            rejected["sender_limit"] += 1
             await msg.answer(reason)
             return
 
-        text = msg.text or msg.caption or ""
-        if rs["block_links"] == 1 and text and has_link(text):
-            await msg.answer("Ссылки запрещены у получателя. Уберите ссылку и попробуйте снова.")
-            return
+        with_link = False
+        for part in msgs:
+            verdict = content_filter.scan_message(part)
+            if verdict.reject:
+                rejected["filter"] += 1
+                await msg.answer(verdict.reject)
+                return
+            with_link = with_link or verdict.has_link
 
-        thread_id = repo.thread_id(recipient_id, sender_id)
-        markup = kb_inbound(thread_id, sender_id).as_markup()
+        if len(msgs) > 1:
+            payload = album_payload(msgs)
+            idem_key = f"{msg.chat.id}:g{msg.media_group_id}"
+        else:
+            payload = message_payload(msg)
+            idem_key = f"{msg.chat.id}:{msg.message_id}"
+        adm = await repo.admit_delivery(
+            sender_id, recipient_id, cfg.default_block_links,
+            cfg.cooldown_sec, cfg.daily_limit_per_pair, with_link, idem_key, payload,
+        )
+        if adm.verdict == "duplicate":
+            return
+        if not adm.ok:
+            rejected[adm.verdict] += 1
+            await msg.answer(adm.message)
+            return
 
+        delivered.add()
+        await repo.log_message(adm.thread_id, payload)
+        outbox.wake.set()
         await msg.answer("Отправлено ✅")
 
-        if msg.text:
-            await bot.send_message(recipient_id, f"📩 Анонимное сообщение:\n\n{msg.text}", reply_markup=markup)
-        elif msg.photo:
-            await bot.send_photo(
-                recipient_id, msg.photo[-1].file_id,
-                caption=(msg.caption or "📩 Анонимное сообщение"),
-                reply_markup=markup,
-            )
-        elif msg.video:
-            await bot.send_video(
-                recipient_id, msg.video.file_id,
-                caption=(msg.caption or "📩 Анонимное сообщение"),
-                reply_markup=markup,
-            )
-        elif msg.voice:
-            await bot.send_voice(
-                recipient_id, msg.voice.file_id,
-                caption=(msg.caption or "📩 Анонимное сообщение"),
-                reply_markup=markup,
-            )
-        elif msg.video_note:
-            await bot.send_video_note(recipient_id, msg.video_note.file_id, reply_markup=markup)
-        elif msg.document:
-            await bot.send_document(
-                recipient_id, msg.document.file_id,
-                caption=(msg.caption or "📩 Анонимное сообщение"),
-                reply_markup=markup,
-            )
-        else:
-            await bot.send_message(recipient_id, "📩 Анонимное сообщение", reply_markup=markup)
-
-        repo.clear_pending(sender_id)
+    albums = AlbumCollector(cfg.album_wait_sec, deliver_parts)
 
     @dp.message(Command("id"))
     async def cmd_id(m: Message):
@@ -448,16 +2895,16 @@ async def run_bot(cfg: Config) -> None:
             return
         user_id = m.from_user.id
 
-        if repo.is_banned(user_id):
+        if await repo.is_banned(user_id):
             await m.answer("Доступ ограничен.")
             return
 
-        repo.ensure_user(user_id, cfg.default_block_links)
+        await repo.ensure_user(user_id, cfg.default_block_links)
 
         parts = (m.text or "").split(maxsplit=1)
         if len(parts) == 2 and parts[1].startswith("u_"):
             code = parts[1][2:]
-            recipient_id = repo.user_by_code(code)
+            recipient_id = await repo.user_by_code(code)
             if not recipient_id:
                 await m.answer("Ссылка недействительна.")
                 return
@@ -467,21 +2914,28 @@ async def run_bot(cfg: Config) -> None:
                 await m.answer(f"Ваша ссылка:\n{link}", reply_markup=home_kb.as_markup())
                 return
 
-            rs = repo.settings(recipient_id, cfg.default_block_links)
+            rs = await repo.settings(recipient_id, cfg.default_block_links)
             if rs["anon_enabled"] == 0:
                 await m.answer("У пользователя отключены анонимные сообщения.")
                 return
 
-            if repo.is_blocked(recipient_id, user_id):
+            if await repo.is_blocked(recipient_id, user_id):
                 await m.answer("Вы не можете отправлять сообщения этому пользователю.")
                 return
 
-            repo.set_pending(user_id, recipient_id)
+            limited, reason, flag = guard.check_link(user_id, recipient_id)
+            if flag:
+                flag_sender(user_id, flag)
+            if limited:
+                await m.answer(reason)
+                return
+
+            await repo.set_pending(user_id, recipient_id)
             await m.answer("Напишите сообщение — я доставлю его анонимно.")
             return
 
         link, home_kb = await render_home(user_id)
-        s = repo.settings(user_id, cfg.default_block_links)
+        s = await repo.settings(user_id, cfg.default_block_links)
         status = "включены" if s["anon_enabled"] == 1 else "отключены"
         await m.answer(f"Анонимные сообщения: {status}\n\nВаша ссылка:\n{link}", reply_markup=home_kb.as_markup())
 
@@ -490,7 +2944,7 @@ async def run_bot(cfg: Config) -> None:
         if not m.from_user:
             return
         user_id = m.from_user.id
-        if repo.is_banned(user_id):
+        if await repo.is_banned(user_id):
             await m.answer("Доступ ограничен.")
             return
         link, home_kb = await render_home(user_id)
@@ -501,7 +2955,7 @@ async def run_bot(cfg: Config) -> None:
         if not m.from_user:
             return
         user_id = m.from_user.id
-        if repo.is_banned(user_id):
+        if await repo.is_banned(user_id):
             await m.answer("Доступ ограничен.")
             return
         link, home_kb = await render_home(user_id)
@@ -520,8 +2974,8 @@ async def run_bot(cfg: Config) -> None:
         if not c.from_user:
             return
         uid = c.from_user.id
-        s = repo.settings(uid, cfg.default_block_links)
-        repo.set_anon(uid, s["anon_enabled"] == 0)
+        s = await repo.settings(uid, cfg.default_block_links)
+        await repo.set_anon(uid, s["anon_enabled"] == 0)
         link, home_kb = await render_home(uid)
         await c.answer("Готово.")
         await c.message.edit_text(f"Ваша ссылка:\n{link}", reply_markup=home_kb.as_markup())
@@ -531,8 +2985,8 @@ async def run_bot(cfg: Config) -> None:
         if not c.from_user:
             return
         uid = c.from_user.id
-        s = repo.settings(uid, cfg.default_block_links)
-        repo.set_block_links(uid, s["block_links"] == 0)
+        s = await repo.settings(uid, cfg.default_block_links)
+        await repo.set_block_links(uid, s["block_links"] == 0)
         link, home_kb = await render_home(uid)
         await c.answer("Готово.")
         await c.message.edit_text(f"Ваша ссылка:\n{link}", reply_markup=home_kb.as_markup())
@@ -542,16 +2996,44 @@ async def run_bot(cfg: Config) -> None:
         if not c.from_user:
             return
         uid = c.from_user.id
-        if repo.is_banned(uid):
+        if await repo.is_banned(uid):
+            await c.answer("Доступ ограничен.", show_alert=True)
+            return
+        await render_inbox(c, uid, None)
+
+    @dp.callback_query(F.data.startswith("inboxp:"))
+    async def ui_inbox_page(c: CallbackQuery):
+        if not c.from_user:
+            return
+        uid = c.from_user.id
+        if await repo.is_banned(uid):
             await c.answer("Доступ ограничен.", show_alert=True)
             return
-        threads = repo.inbox_threads(uid, cfg.inbox_limit)
-        if not threads:
+        parts = c.data.split(":")
+        if len(parts) != 3 or not parts[1].isdigit() or not parts[2].isdigit():
+            await c.answer()
+            return
+        await render_inbox(c, uid, (int(parts[1]), int(parts[2])))
+
+    async def render_inbox(c: CallbackQuery, uid: int, before: Optional[Tuple[int, int]]) -> None:
+        rows = await repo.inbox_threads(uid, cfg.inbox_limit + 1, before)
+        if not rows and before is None:
             await c.answer()
             await c.message.edit_text("Инбокс пуст.", reply_markup=None)
             return
+        threads = rows[:cfg.inbox_limit]
+        next_cursor = ""
+        if len(rows) > cfg.inbox_limit:
+            last = threads[-1]
+            next_cursor = f"{int(last['updated_ts'])}:{int(last['id'])}"
+        unread = await repo.unread_total(uid)
+        header = "Последние диалоги:" if before is None else "Ранее:"
+        if unread:
+            header = f"Непрочитанных: {unread}\n\n{header}"
         await c.answer()
-        await c.message.edit_text("Последние диалоги:", reply_markup=kb_inbox_list(threads).as_markup())
+        await c.message.edit_text(
+            header, reply_markup=kb_inbox_list(threads, next_cursor, before is None).as_markup()
+        )
 
     @dp.callback_query(F.data.startswith("inbox:"))
     async def inbox_open(c: CallbackQuery):
@@ -559,7 +3041,7 @@ async def run_bot(cfg: Config) -> None:
             return
         uid = c.from_user.id
         tid = int(c.data.split(":", 1)[1])
-        parties = repo.thread_parties(tid)
+        parties = await repo.thread_parties(tid)
         if not parties:
             await c.answer("Диалог не найден.", show_alert=True)
             return
@@ -567,22 +3049,46 @@ async def run_bot(cfg: Config) -> None:
         if uid != recipient_id:
             await c.answer("Нет доступа.", show_alert=True)
             return
-        await c.answer()
-        await c.message.edit_text(
-            f"Диалог #{tid}\n\nНажмите «Ответить», чтобы написать.",
-            reply_markup=kb_inbound(tid, sender_id).as_markup(),
-        )
+        await repo.mark_read(tid)
+        await render_thread(c, tid, sender_id, None)
 
-    @dp.message(F.content_type.in_({"text", "photo", "video", "voice", "video_note", "document"}))
-    async def on_content(m: Message):
-        if not m.from_user:
+    @dp.callback_query(F.data.startswith("hist:"))
+    async def history_page(c: CallbackQuery):
+        if not c.from_user:
             return
-        sender_id = m.from_user.id
-        target = repo.pending_target(sender_id)
-        if not target:
-            await m.answer("Чтобы отправить анонимное сообщение, перейдите по персональной ссылке получателя.")
+        parts = c.data.split(":")
+        if len(parts) != 3 or not parts[1].isdigit() or not parts[2].isdigit():
+            await c.answer()
             return
-        await deliver(sender_id, target, m)
+        tid = int(parts[1])
+        parties = await repo.thread_parties(tid)
+        if not parties:
+            await c.answer("Диалог не найден.", show_alert=True)
+            return
+        recipient_id, sender_id = parties
+        if c.from_user.id != recipient_id:
+            await c.answer("Нет доступа.", show_alert=True)
+            return
+        await render_thread(c, tid, sender_id, int(parts[2]))
+
+    async def render_thread(c: CallbackQuery, tid: int, sender_id: int, before_id: Optional[int]) -> None:
+        await repo.flush_messages()
+        rows = await repo.thread_messages(tid, cfg.history_page + 1, before_id)
+        page = rows[:cfg.history_page]
+        lines = [f"Диалог #{tid}", ""]
+        for r in page:
+            lines.append(format_history_line(r))
+        if not page:
+            lines.append("История пуста." if before_id is None else "Больше сообщений нет.")
+        lines.append("\nНажмите «Ответить», чтобы написать.")
+        kb = kb_inbound(tid, sender_id)
+        if len(rows) > cfg.history_page:
+            kb.button(text="⬅️ Раньше", callback_data=f"hist:{tid}:{int(page[-1]['id'])}")
+        if before_id is not None:
+            kb.button(text="⏭ Новые", callback_data=f"inbox:{tid}")
+        kb.adjust(2, 1, 2)
+        await c.answer()
+        await c.message.edit_text("\n".join(lines), reply_markup=kb.as_markup())
 
     @dp.callback_query(F.data.startswith("block:"))
     async def on_block(c: CallbackQuery):
@@ -590,7 +3096,7 @@ async def run_bot(cfg: Config) -> None:
             return
         recipient_id = c.from_user.id
         sender_id = int(c.data.split(":", 1)[1])
-        repo.block(recipient_id, sender_id)
+        await repo.block(recipient_id, sender_id)
         await c.answer("Заблокировано.")
         try:
             await c.message.edit_reply_markup(reply_markup=None)
@@ -603,7 +3109,7 @@ async def run_bot(cfg: Config) -> None:
             return
         uid = c.from_user.id
         tid = int(c.data.split(":", 1)[1])
-        parties = repo.thread_parties(tid)
+        parties = await repo.thread_parties(tid)
         if not parties:
             await c.answer("Тред не найден.", show_alert=True)
             return
@@ -611,10 +3117,10 @@ async def run_bot(cfg: Config) -> None:
         if uid != recipient_id:
             await c.answer("Нельзя ответить.", show_alert=True)
             return
-        if repo.is_banned(sender_id) or repo.is_blocked(sender_id, recipient_id):
+        if await repo.is_banned(sender_id) or await repo.is_blocked(sender_id, recipient_id):
             await c.answer("Нельзя ответить.", show_alert=True)
             return
-        repo.set_pending(recipient_id, sender_id)
+        await repo.set_pending(recipient_id, sender_id)
         await c.answer()
         await c.message.reply("Напишите ответ — я доставлю его анонимно отправителю.")
 
@@ -624,7 +3130,7 @@ async def run_bot(cfg: Config) -> None:
             return
         reporter_id = c.from_user.id
         tid = int(c.data.split(":", 1)[1])
-        parties = repo.thread_parties(tid)
+        parties = await repo.thread_parties(tid)
         if not parties:
             await c.answer("Тред не найден.", show_alert=True)
             return
@@ -633,16 +3139,12 @@ async def run_bot(cfg: Config) -> None:
             await c.answer("Нельзя.", show_alert=True)
             return
 
-        await c.answer("Жалоба отправлена.")
-        if cfg.admin_id > 0:
-            try:
-                await bot.send_message(
-                    cfg.admin_id,
-                    f"⚠️ Жалоба\nthread_id={tid}\nrecipient_id={recipient_id}\nsender_id={sender_id}\n"
-                    f"/ban {sender_id}\n/unban {sender_id}",
-                )
-            except Exception:
-                pass
+        added, _, banned = await repo.add_report(
+            tid, reporter_id, sender_id, cfg.report_window_sec, cfg.report_autoban_threshold
+        )
+        if banned:
+            autobanned.append(sender_id)
+        await c.answer("Жалоба отправлена." if added else "Жалоба уже отправлена.")
 
     @dp.message(Command("ban"))
     async def cmd_ban(m: Message):
@@ -653,7 +3155,7 @@ async def run_bot(cfg: Config) -> None:
             await m.answer("Использование: /ban <user_id>")
             return
         uid = int(parts[1])
-        repo.ban(uid)
+        await repo.ban(uid)
         await m.answer(f"Забанен: {uid}")
 
     @dp.message(Command("unban"))
@@ -665,18 +3167,121 @@ async def run_bot(cfg: Config) -> None:
             await m.answer("Использование: /unban <user_id>")
             return
         uid = int(parts[1])
-        repo.unban(uid)
+        await repo.unban(uid)
         await m.answer(f"Разбанен: {uid}")
 
+    @dp.message(Command("broadcast"))
+    async def cmd_broadcast(m: Message):
+        if not m.from_user or m.from_user.id != cfg.admin_id:
+            return
+        parts = (m.text or "").split(maxsplit=1)
+        if len(parts) != 2 or not parts[1].strip():
+            await m.answer("Использование: /broadcast <текст>")
+            return
+        row = await repo.broadcast_create(parts[1].strip())
+        broadcaster.start(row)
+        await m.answer(f"Рассылка #{row['id']} запущена, получателей: {row['total']}.\nОтмена: /broadcast_stop {row['id']}")
+
+    @dp.message(Command("broadcast_stop"))
+    async def cmd_broadcast_stop(m: Message):
+        if not m.from_user or m.from_user.id != cfg.admin_id:
+            return
+        parts = (m.text or "").split()
+        if len(parts) != 2 or not parts[1].isdigit():
+            await m.answer("Использование: /broadcast_stop <id>")
+            return
+        bid = int(parts[1])
+        await m.answer(f"Рассылка #{bid} остановлена." if broadcaster.cancel(bid) else f"Рассылка #{bid} не запущена.")
+
+    @dp.message(Command("backup"))
+    async def cmd_backup(m: Message):
+        if not m.from_user or m.from_user.id != cfg.admin_id:
+            return
+        await m.answer("Создаю резервную копию…")
+        try:
+            res = await backups.run()
+        except Exception as e:
+            logging.exception("backup failed")
+            await m.answer(f"Ошибка резервного копирования: {e}")
+            return
+        if res is None:
+            await m.answer("Резервное копирование уже выполняется.")
+            return
+        await m.answer(
+            f"Готово: {os.path.basename(res['path'])}\n"
+            f"размер={res['bytes']}\nвремя={res['seconds']} с\nпользователей={res.get('users', 0)}\n"
+            f"удалено старых={res['rotated']}"
+        )
+
     @dp.message(Command("stats"))
     async def cmd_stats(m: Message):
         if not m.from_user or m.from_user.id != cfg.admin_id:
             return
-        users, threads, bans = repo.stats()
-        await m.answer(f"users={users}\nthreads={threads}\nbans={bans}")
+        st = await repo.stats()
+        db = await repo.counters()
+        await m.answer(
+            f"users={st['users']}\nthreads={st['threads']}\nbans={st['bans']}\n"
+            f"msgs_per_min_in={received.count()}\nmsgs_per_min_delivered={delivered.count()}\n"
+            f"msgs_total_in={received.total}\nmsgs_total_delivered={delivered.total}\n"
+            f"rate_limit_hits={rejected['limited'] + rejected['sender_limit']}\n"
+            + "".join(f"rejected_{k}={v}\n" for k, v in sorted(rejected.items()))
+            + f"db_pages={st['page_count']}\ndb_free_pages={st['freelist_count']}\ndb_page_size={st['page_size']}\n"
+            f"db_bytes={st['db_bytes']}\ndb_wal_bytes={st['wal_bytes']}\n"
+            f"db_connections={db['connections_opened']}\ndb_statements={db['statements']}\n"
+            f"cache_hits={db['cache_hits']}\ncache_misses={db['cache_misses']}\ncache_hit_pct={db['cache_hit_pct']}\n"
+            f"cache_evictions={db['cache_evictions']}\ncache_size={db['cache_size']}\n"
+            + "\n".join(f"send_{k}={v}" for k, v in outbound.stats().items()) + "\n"
+            + "".join(f"outbox_{k}={st[f'outbox_{k}']}\n" for k in OUTBOX_STATUSES)
+            + "\n".join(f"guard_{k}={v}" for k, v in guard.stats().items())
+        )
+
+    @dp.message(F.content_type.in_({"text", "photo", "video", "voice", "video_note", "document"}))
+    async def on_content(m: Message):
+        if not m.from_user:
+            return
+        sender_id = m.from_user.id
+        await albums.settle(sender_id, m.media_group_id)
+        if m.media_group_id:
+            target = albums.target(sender_id, m.media_group_id)
+            if target:
+                albums.add(sender_id, target, m)
+                return
+        target = await repo.pending_target(sender_id)
+        if not target:
+            await m.answer("Чтобы отправить анонимное сообщение, перейдите по персональной ссылке получателя.")
+            return
+        if m.media_group_id:
+            albums.add(sender_id, target, m)
+            return
+        await deliver(sender_id, target, m)
 
-    await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot)
+    return dp
+
+
+async def run_bot(cfg: Config) -> None:
+    repo = AsyncRepo(
+        Repo(
+            cfg.db_path,
+            cache_size=cfg.cache_size,
+            cache_ttl_sec=cfg.cache_ttl_sec,
+            history_per_thread=cfg.history_per_thread,
+            history_max_rows=cfg.history_max_rows,
+            slow_query_ms=cfg.slow_query_ms,
+        ),
+        cfg.db_readers,
+    )
+    await repo.init()
+
+    bot = Bot(cfg.token)
+    dp = build_dispatcher(cfg, bot, repo)
+    try:
+        if cfg.mode == "webhook":
+            await WebhookServer(cfg, bot, dp).run()
+        else:
+            await bot.delete_webhook(drop_pending_updates=True)
+            await dp.start_polling(bot, tasks_concurrency_limit=cfg.max_pending_updates)
+    finally:
+        repo.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,45 @@
+import argparse
+import os
+
+from MainBot import Backups, restore_snapshot, verify_snapshot
+
+DEFAULT_DB = os.path.join(os.path.dirname(os.path.abspath(__file__)), "anon.db")
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Snapshots of anon.db: create, list, verify, restore")
+    ap.add_argument("--db", default=DEFAULT_DB)
+    ap.add_argument("--dir", default="", help="snapshot directory (default: backups/ next to the database)")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    snap = sub.add_parser("snapshot", help="online backup of a live database")
+    snap.add_argument("--keep", type=int, default=7)
+    sub.add_parser("list")
+    ver = sub.add_parser("verify")
+    ver.add_argument("path", nargs="?", help="snapshot file (default: all)")
+    res = sub.add_parser("restore", help="replace the database with a snapshot; stop the bot first")
+    res.add_argument("path", nargs="?", help="snapshot file (default: newest)")
+    args = ap.parse_args()
+
+    backups = Backups(args.db, args.dir, getattr(args, "keep", 0), 256, 0.005)
+    if args.cmd == "snapshot":
+        print(backups.snapshot())
+    elif args.cmd == "list":
+        for path in backups.snapshots():
+            print(f"{path}  {os.path.getsize(path)}")
+    elif args.cmd == "verify":
+        failed = 0
+        for path in [args.path] if args.path else backups.snapshots():
+            r = verify_snapshot(path)
+            failed += not r["ok"]
+            print(f"{path}  {r}")
+        raise SystemExit(1 if failed else 0)
+    elif args.cmd == "restore":
+        snapshots = backups.snapshots()
+        path = args.path or (snapshots[-1] if snapshots else None)
+        if not path:
+            raise SystemExit("no snapshots found")
+        print(restore_snapshot(path, args.db))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+import argparse
+import asyncio
+import os
+import random
+import string
+import tempfile
+import time
+
+from MainBot import Config, ContentFilter, Repo, Storage, has_link
+from loadtest import LoadTest, message_update, percentile
+from test_conformance import BACKENDS
+
+
+def sample_texts(n: int, seed: int = 1) -> list[str]:
+    rnd = random.Random(seed)
+    words = ["привет", "как", "дела", "hello", "anon", "вопрос", "ответ", "ну", "да", "нет"]
+    out = []
+    for i in range(n):
+        t = " ".join(rnd.choice(words) for _ in range(rnd.randint(3, 60)))
+        if i % 10 == 0:
+            t += " https://" + "".join(rnd.choice(string.ascii_lowercase) for _ in range(8)) + ".com/x"
+        elif i % 10 == 1:
+            t += " t.me/" + "".join(rnd.choice(string.ascii_lowercase) for _ in range(6))
+        out.append(t)
+    return out
+
+
+def report(name: str, lat: list[float], elapsed: float) -> None:
+    print(
+        f"{name:<32} {elapsed / len(lat) * 1e6:9.2f} us/op  {len(lat) / elapsed:10.0f} ops/s  "
+        f"p50 {percentile(lat, 0.5) * 1e6:8.2f} us  p99 {percentile(lat, 0.99) * 1e6:8.2f} us"
+    )
+
+
+def bench(name: str, fn, items: list, repeat: int = 5) -> float:
+    best, best_lat = float("inf"), []
+    for _ in range(repeat):
+        lat = []
+        t0 = time.perf_counter()
+        for x in items:
+            t = time.perf_counter()
+            fn(x)
+            lat.append(time.perf_counter() - t)
+        elapsed = time.perf_counter() - t0
+        if elapsed < best:
+            best, best_lat = elapsed, lat
+    report(name, best_lat, best)
+    return best / len(items) * 1e6
+
+
+def populate(repo: Repo, users: int, threads: int, seed: int = 1) -> None:
+    rnd = random.Random(seed)
+    con = repo._con()
+    now = int(time.time())
+    con.executemany(
+        "INSERT OR IGNORE INTO users(user_id, code, created_at) VALUES(?,?,'')",
+        ((u, f"b{u:x}") for u in range(1, users + 1)),
+    )
+    con.executemany(
+        "INSERT OR IGNORE INTO threads(recipient_id, sender_id, created_at, updated_at, created_ts, updated_ts) "
+        "VALUES(?,?,'','',?,?)",
+        ((rnd.randint(1, users), rnd.randint(1, users), now, now - rnd.randint(0, 86400 * 30)) for _ in range(threads)),
+    )
+    con.commit()
+
+
+def bench_repo(n: int, users: int, threads: int) -> None:
+    repo = Repo(os.path.join(tempfile.mkdtemp(prefix="anon-bench-"), "bench.db"))
+    repo.init()
+    t0 = time.perf_counter()
+    populate(repo, users, threads)
+    print(f"populated {users} users / {threads} threads in {time.perf_counter() - t0:.1f}s")
+    rnd = random.Random(2)
+    pairs = [(rnd.randint(1, users), rnd.randint(1, users)) for _ in range(n)]
+    existing = [tuple(r) for r in repo._con().execute(
+        "SELECT recipient_id, sender_id FROM threads ORDER BY random() LIMIT ?", (n,)
+    )]
+    recipients = [rnd.randint(1, users) for _ in range(n)]
+    bench("Repo.rate_check_and_touch", lambda p: repo.rate_check_and_touch(p[0], p[1], 0, 1_000_000), pairs, 3)
+    bench("Repo.thread_id (existing)", lambda p: repo.thread_id(p[0], p[1]), existing, 3)
+    bench("Repo.inbox_threads", lambda r: repo.inbox_threads(r, 12), recipients, 3)
+    repo.close()
+
+
+async def bench_deliver_async(n: int, users: int) -> None:
+    db_path = os.path.join(tempfile.mkdtemp(prefix="anon-bench-"), "deliver.db")
+    cfg = Config(
+        token="123:bench", admin_id=0, db_path=db_path, cooldown_sec=0, daily_limit_per_pair=1_000_000,
+        send_global_rate=1e9, send_chat_rate=1e9, sender_max_per_window=1_000_000, fanout_max_recipients=1_000_000,
+    )
+    async with LoadTest(cfg) as lt:
+        populate(lt.repo.repo, users, 0)
+        rnd = random.Random(3)
+        lat = []
+        elapsed = 0.0
+        for _ in range(n):
+            sender, recipient = rnd.randint(1, users), rnd.randint(1, users)
+            await lt.repo.set_pending(sender, recipient)
+            update = message_update(sender, "привет, это анонимный вопрос")
+            t0 = time.perf_counter()
+            await lt.dp.feed_raw_update(lt.bot, update)
+            dt = time.perf_counter() - t0
+            lat.append(dt)
+            elapsed += dt
+        report("deliver (update -> outbox)", lat, elapsed)
+
+
+def bench_storage(n: int, users: int) -> None:
+    rnd = random.Random(4)
+    ids = [rnd.randint(1, users) for _ in range(n)]
+    pairs = [(rnd.randint(1, users), rnd.randint(1, users)) for _ in range(n)]
+    for name, make in sorted(BACKENDS.items()):
+        st: Storage = make()
+        st.init()
+        print(f"-- {name}")
+        t0 = time.perf_counter()
+        for u in range(1, users + 1):
+            st.ensure_user(u, 1)
+        for r, s in pairs:
+            st.thread_id(r, s, 1)
+        print(f"loaded {users} users / {n} threads in {time.perf_counter() - t0:.1f}s")
+        bench("settings", lambda u: st.settings(u, 1), ids, 3)
+        bench("set_pending + pending_target", lambda u: (st.set_pending(u, u + 1), st.pending_target(u)), ids, 3)
+        bench("is_banned + is_blocked", lambda p: st.is_banned(p[0]) or st.is_blocked(p[0], p[1]), pairs, 3)
+        bench("thread_id (existing)", lambda p: st.thread_id(p[0], p[1]), pairs, 3)
+        bench("inbox_threads", lambda u: st.inbox_threads(u, 12), ids, 3)
+        bench("rate_check_and_touch", lambda p: st.rate_check_and_touch(p[0], p[1], 0, 1_000_000), pairs, 3)
+        st.close()
+
+
+def bench_filter(n: int) -> None:
+    texts = sample_texts(n)
+    plain = ContentFilter()
+    rules = ContentFilter()
+    rules.load({
+        "deny_domains": [f"spam{i}.example" for i in range(200)],
+        "allow_domains": ["youtube.com", "t.me"],
+        "banned_words": [f"слово{i}" for i in range(500)],
+    })
+    bench("has_link", has_link, texts)
+    bench("ContentFilter.scan (no rules)", plain.scan, texts)
+    bench("ContentFilter.scan (700 rules)", rules.scan, texts)
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-n", type=int, default=20000)
+    ap.add_argument("--users", type=int, default=100_000)
+    ap.add_argument("--threads", type=int, default=500_000)
+    ap.add_argument("--only", choices=["filter", "repo", "deliver", "storage"], default="")
+    args = ap.parse_args()
+    if args.only in ("", "filter"):
+        bench_filter(args.n)
+    if args.only in ("", "repo"):
+        bench_repo(min(args.n, 5000), args.users, args.threads)
+    if args.only in ("", "deliver"):
+        asyncio.run(bench_deliver_async(min(args.n, 2000), args.users))
+    if args.only in ("", "storage"):
+        bench_storage(min(args.n, 20000), min(args.users, 20000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import tempfile
+import time
+from collections import Counter, defaultdict
+from typing import Optional
+
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.types import InlineKeyboardMarkup
+
+from MainBot import AsyncRepo, Config, Repo, build_dispatcher
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "bot", "username": "anonbot"}
+
+
+class FakeSession(BaseSession):
+    def __init__(self, latency: float = 0.0, forbidden: Optional[set[int]] = None):
+        super().__init__()
+        self.latency = latency
+        self.forbidden = forbidden or set()
+        self.calls: Counter = Counter()
+        self.buttons: dict[int, list[str]] = defaultdict(list)
+        self._mid = itertools.count(1)
+
+    def _message(self, chat_id: int, text: str = "") -> dict:
+        return {
+            "message_id": next(self._mid), "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"}, "from": BOT_USER, "text": text,
+        }
+
+    async def make_request(self, bot, method, timeout=None):
+        name = method.__api_method__
+        self.calls[name] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id in self.forbidden:
+            body = {"ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user"}
+            return self.check_response(bot, method, 403, json.dumps(body)).result
+        markup = getattr(method, "reply_markup", None)
+        if isinstance(markup, InlineKeyboardMarkup) and chat_id is not None:
+            self.buttons[chat_id].extend(b.callback_data for row in markup.inline_keyboard for b in row if b.callback_data)
+        if name == "getMe":
+            result = BOT_USER
+        elif name == "sendMediaGroup":
+            result = [self._message(chat_id) for _ in method.media]
+        elif name.startswith("send") or name == "copyMessage":
+            result = self._message(chat_id, getattr(method, "text", None) or "")
+        else:
+            result = True
+        return self.check_response(bot, method, 200, json.dumps({"ok": True, "result": result})).result
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        raise NotImplementedError
+        yield b""
+
+    async def close(self) -> None:
+        pass
+
+
+_ids = itertools.count(1)
+
+
+def message_update(user_id: int, text: str) -> dict:
+    i = next(_ids)
+    return {"update_id": i, "message": {
+        "message_id": i, "date": int(time.time()), "text": text,
+        "chat": {"id": user_id, "type": "private"}, "from": {"id": user_id, "is_bot": False, "first_name": "u"},
+    }}
+
+
+def callback_update(user_id: int, data: str) -> dict:
+    i = next(_ids)
+    return {"update_id": i, "callback_query": {
+        "id": str(i), "chat_instance": "lt", "data": data,
+        "from": {"id": user_id, "is_bot": False, "first_name": "u"},
+        "message": {"message_id": i, "date": int(time.time()), "chat": {"id": user_id, "type": "private"}, "text": "x"},
+    }}
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    s = sorted(values)
+    return s[min(len(s) - 1, int(len(s) * q))]
+
+
+class LoadTest:
+    def __init__(self, cfg: Config, latency: float = 0.0, seed: int = 1):
+        self.cfg = cfg
+        self.session = FakeSession(latency)
+        self.bot = Bot("123:loadtest", session=self.session)
+        self.repo = AsyncRepo(Repo(cfg.db_path, cache_size=cfg.cache_size), cfg.db_readers)
+        self.dp = build_dispatcher(cfg, self.bot, self.repo)
+        self.rnd = random.Random(seed)
+        self.lat: dict[str, list[float]] = defaultdict(list)
+        self.codes: dict[int, str] = {}
+
+    async def __aenter__(self) -> "LoadTest":
+        await self.repo.init()
+        await self.dp.emit_startup(bot=self.bot, dispatcher=self.dp)
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.dp.emit_shutdown(bot=self.bot, dispatcher=self.dp)
+        await self.bot.session.close()
+        self.repo.close()
+
+    async def feed(self, kind: str, update: dict) -> None:
+        t0 = time.perf_counter()
+        await self.dp.feed_raw_update(self.bot, update)
+        self.lat[kind].append(time.perf_counter() - t0)
+
+    async def wait_button(self, user_id: int, prefix: str, timeout: float = 5.0) -> Optional[str]:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            for data in self.session.buttons.get(user_id, ()):
+                if data.startswith(prefix):
+                    self.session.buttons[user_id].remove(data)
+                    return data
+            await asyncio.sleep(0.01)
+        return None
+
+    async def register(self, users: list[int], concurrency: int) -> None:
+        slots = asyncio.Semaphore(concurrency)
+
+        async def one(uid: int) -> None:
+            async with slots:
+                await self.feed("start", message_update(uid, "/start"))
+                self.codes[uid] = (await self.repo.settings(uid, self.cfg.default_block_links))["code"]
+
+        await asyncio.gather(*(one(u) for u in users))
+
+    async def flow(self, sender: int, users: list[int], messages: int) -> None:
+        recipient = self.rnd.choice(users)
+        while recipient == sender:
+            recipient = self.rnd.choice(users)
+        for i in range(messages):
+            await self.feed("open_link", message_update(sender, f"/start u_{self.codes[recipient]}"))
+            text = "привет, это анонимный вопрос"
+            if self.rnd.random() < 0.1:
+                text += " https://example.com/x"
+            await self.feed("content", message_update(sender, text))
+        roll = self.rnd.random()
+        if roll < 0.5:
+            data = await self.wait_button(recipient, "reply:")
+            if data:
+                await self.feed("reply", callback_update(recipient, data))
+                await self.feed("content", message_update(recipient, "ответ"))
+        elif roll < 0.55:
+            data = await self.wait_button(recipient, "block:")
+            if data:
+                await self.feed("block", callback_update(recipient, data))
+        elif roll < 0.6:
+            data = await self.wait_button(recipient, "report:")
+            if data:
+                await self.feed("report", callback_update(recipient, data))
+
+    async def run(self, users: int, messages: int, concurrency: int) -> float:
+        ids = list(range(1000, 1000 + users))
+        await self.register(ids, concurrency)
+        slots = asyncio.Semaphore(concurrency)
+
+        async def one(uid: int) -> None:
+            async with slots:
+                await self.flow(uid, ids, messages)
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*(one(u) for u in ids))
+        return time.perf_counter() - t0
+
+    def report(self, elapsed: float) -> None:
+        total = sum(len(v) for v in self.lat.values())
+        print(f"{'update':<12} {'count':>8} {'p50 ms':>9} {'p99 ms':>9}")
+        for kind, values in sorted(self.lat.items()):
+            print(f"{kind:<12} {len(values):8d} {percentile(values, 0.5) * 1000:9.2f} {percentile(values, 0.99) * 1000:9.2f}")
+        print(f"updates: {total} in {elapsed:.2f}s, {total / max(elapsed, 1e-9):.0f} updates/s")
+        print("api calls: " + ", ".join(f"{k}={v}" for k, v in sorted(self.session.calls.items())))
+
+
+async def main_async(args: argparse.Namespace) -> None:
+    db_path = args.db or os.path.join(tempfile.mkdtemp(prefix="anon-lt-"), "load.db")
+    cfg = Config(
+        token="123:loadtest", admin_id=0, db_path=db_path, cooldown_sec=0, daily_limit_per_pair=1_000_000,
+        send_workers=args.send_workers, send_global_rate=1e9, send_chat_rate=1e9,
+        sender_max_per_window=1_000_000, fanout_max_recipients=1_000_000, history_flush_sec=0.5,
+    )
+    async with LoadTest(cfg, latency=args.latency / 1000, seed=args.seed) as lt:
+        elapsed = await lt.run(args.users, args.messages, args.concurrency)
+        lt.report(elapsed)
+    print(f"database: {db_path}")
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Offline load test against an in-process fake Bot API")
+    ap.add_argument("--users", type=int, default=1000)
+    ap.add_argument("--messages", type=int, default=3, help="messages per sender")
+    ap.add_argument("--concurrency", type=int, default=64)
+    ap.add_argument("--latency", type=float, default=0.0, help="simulated Bot API latency, ms")
+    ap.add_argument("--send-workers", type=int, default=8)
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--db", default="", help="database path (default: fresh temp file)")
+    asyncio.run(main_async(ap.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
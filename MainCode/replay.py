@@ -0,0 +1,115 @@
+import argparse
+import asyncio
+import gzip
+import json
+import os
+import re
+import tempfile
+import time
+from typing import Iterator
+
+from aiogram.types import Update
+
+from MainBot import Config
+from loadtest import LoadTest
+
+THREAD_REF = re.compile(r"^(\w+):@(\d+)\.(\d+)(.*)$")
+
+
+def read_records(path: str) -> Iterator[dict]:
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def read_admin(path: str) -> int:
+    for rec in read_records(path):
+        if "recorder" in rec:
+            return int(rec["admin_id"])
+        break
+    return 0
+
+
+def update_kind(raw: dict) -> str:
+    if "callback_query" in raw:
+        data = raw["callback_query"].get("data", "")
+        return "cb:" + data.split(":", 1)[0]
+    msg = raw.get("message") or {}
+    if msg.get("media_group_id"):
+        return "album"
+    text = msg.get("text", "")
+    if text.startswith("/"):
+        return text.split(maxsplit=1)[0]
+    return "message"
+
+
+async def resolve(lt: LoadTest, raw: dict) -> dict:
+    msg = raw.get("message")
+    if msg and msg.get("text", "").startswith("/start u_@"):
+        owner = int(msg["text"].split("@", 1)[1])
+        msg["text"] = f"/start u_{await lt.repo.ensure_user(owner, lt.cfg.default_block_links)}"
+    cq = raw.get("callback_query")
+    if cq and cq.get("data"):
+        m = THREAD_REF.match(cq["data"])
+        if m:
+            tid = await lt.repo.thread_id(int(m.group(2)), int(m.group(3)))
+            cq["data"] = f"{m.group(1)}:{tid}{m.group(4)}"
+    return raw
+
+
+async def replay(lt: LoadTest, path: str, speed: float) -> dict:
+    pending: set[asyncio.Task] = set()
+    start_wall = time.monotonic()
+    first_ts = None
+    max_lag = 0.0
+
+    async def feed(kind: str, update: Update) -> None:
+        t0 = time.perf_counter()
+        try:
+            await lt.dp.feed_update(lt.bot, update)
+        finally:
+            lt.lat[kind].append(time.perf_counter() - t0)
+
+    for rec in read_records(path):
+        if "update" not in rec:
+            continue
+        if first_ts is None:
+            first_ts = rec["ts"]
+        if speed > 0:
+            due = start_wall + (rec["ts"] - first_ts) / speed
+            delay = due - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                max_lag = max(max_lag, -delay)
+        raw = await resolve(lt, rec["update"])
+        update = Update.model_validate(raw, context={"bot": lt.bot})
+        task = asyncio.create_task(feed(update_kind(raw), update))
+        pending.add(task)
+        task.add_done_callback(pending.discard)
+    await asyncio.gather(*pending, return_exceptions=True)
+    return {"elapsed": time.monotonic() - start_wall, "max_lag": max_lag}
+
+
+async def main_async(args: argparse.Namespace) -> None:
+    db_path = args.db or os.path.join(tempfile.mkdtemp(prefix="anon-replay-"), "replay.db")
+    cfg = Config(token="123:replay", admin_id=read_admin(args.path), db_path=db_path)
+    async with LoadTest(cfg, latency=args.latency / 1000) as lt:
+        res = await replay(lt, args.path, args.speed)
+        lt.report(res["elapsed"])
+        print(f"max schedule lag: {res['max_lag'] * 1000:.1f} ms")
+    print(f"database: {db_path}")
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Replay a recorded update stream against a scratch database")
+    ap.add_argument("path", help="recording written with Config.record_path (.jsonl.gz)")
+    ap.add_argument("--speed", type=float, default=1.0, help="1 = real time, 100 = 100x faster, 0 = no pauses")
+    ap.add_argument("--latency", type=float, default=0.0, help="simulated Bot API latency, ms")
+    ap.add_argument("--db", default="", help="scratch database path (default: fresh temp file)")
+    asyncio.run(main_async(ap.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+import os
+import tempfile
+from typing import Callable
+
+import pytest
+
+from MainBot import MemoryStorage, Repo, Storage
+
+
+def check_users(st: Storage) -> None:
+    code = st.ensure_user(1, 1)
+    assert code and st.ensure_user(1, 0) == code
+    assert st.user_by_code(code) == 1
+    assert st.user_by_code("missing") is None
+    assert st.settings(1, 0) == {"anon_enabled": 1, "block_links": 1, "code": code}
+    st.set_anon(1, False)
+    st.set_block_links(1, False)
+    assert st.settings(1, 1) == {"anon_enabled": 0, "block_links": 0, "code": code}
+    st.set_anon(1, True)
+    assert st.settings(1, 1)["anon_enabled"] == 1
+    s = st.settings(2, 0)
+    assert s["anon_enabled"] == 1 and s["block_links"] == 0 and st.user_by_code(s["code"]) == 2
+
+
+def check_bans(st: Storage) -> None:
+    assert not st.is_banned(10)
+    st.ban(10)
+    st.ban(10)
+    assert st.is_banned(10) and not st.is_banned(11)
+    st.unban(10)
+    assert not st.is_banned(10)
+    st.unban(10)
+
+
+def check_blocks(st: Storage) -> None:
+    assert not st.is_blocked(20, 21)
+    st.block(20, 21)
+    st.block(20, 21)
+    st.block(20, 19)
+    assert st.is_blocked(20, 21) and st.is_blocked(20, 19)
+    assert not st.is_blocked(21, 20) and not st.is_blocked(20, 22)
+
+
+def check_pending(st: Storage) -> None:
+    assert st.pending_target(30) is None
+    st.set_pending(30, 31)
+    assert st.pending_target(30) == 31
+    st.set_pending(30, 32)
+    assert st.pending_target(30) == 32
+    st.clear_pending(30)
+    st.clear_pending(30)
+    assert st.pending_target(30) is None
+
+
+def check_threads(st: Storage) -> None:
+    st.ensure_user(40, 1)
+    tids = [st.thread_id(40, s) for s in range(41, 46)]
+    assert len(set(tids)) == 5
+    assert st.thread_id(40, 41) == tids[0]
+    assert st.thread_id(41, 40) not in tids
+    assert st.thread_parties(tids[2]) == (40, 43)
+    assert st.thread_parties(10 ** 9) is None
+
+    page = st.inbox_threads(40, 2)
+    seen = [int(r["id"]) for r in page]
+    while page:
+        last = page[-1]
+        page = st.inbox_threads(40, 2, (int(last["updated_ts"]), int(last["id"])))
+        seen += [int(r["id"]) for r in page]
+    assert sorted(seen) == sorted(tids) and len(seen) == len(set(seen))
+    assert st.inbox_threads(12345, 10) == []
+
+    assert st.unread_total(40) == 0
+    st.thread_id(40, 42, 1)
+    st.thread_id(40, 42, 1)
+    st.thread_id(40, 43, 1)
+    assert st.unread_total(40) == 3
+    unread = {int(r["id"]): int(r["unread"]) for r in st.inbox_threads(40, 10)}
+    assert unread[tids[1]] == 2 and unread[tids[2]] == 1 and unread[tids[0]] == 0
+    st.mark_read(tids[1])
+    st.mark_read(tids[1])
+    assert st.unread_total(40) == 1
+    st.mark_read(10 ** 9)
+
+
+def check_rate(st: Storage) -> None:
+    assert st.rate_check_and_touch(50, 51, 60, 30) == (False, "")
+    limited, reason = st.rate_check_and_touch(50, 51, 60, 30)
+    assert limited and reason
+    assert st.rate_check_and_touch(50, 52, 60, 30) == (False, "")
+    assert st.rate_check_and_touch(53, 54, 0, 2) == (False, "")
+    assert st.rate_check_and_touch(53, 54, 0, 2) == (False, "")
+    assert st.rate_check_and_touch(53, 54, 0, 2)[0]
+
+
+CHECKS = [check_users, check_bans, check_blocks, check_pending, check_threads, check_rate]
+
+
+def sqlite_storage() -> Storage:
+    return Repo(os.path.join(tempfile.mkdtemp(prefix="anon-conf-"), "conf.db"))
+
+
+BACKENDS: dict[str, Callable[[], Storage]] = {"sqlite": sqlite_storage, "memory": MemoryStorage}
+
+
+@pytest.mark.parametrize("check", CHECKS, ids=lambda c: c.__name__[len("check_"):])
+@pytest.mark.parametrize("backend", sorted(BACKENDS))
+def test_storage_conformance(backend: str, check: Callable[[Storage], None]):
+    st = BACKENDS[backend]()
+    assert isinstance(st, Storage)
+    st.init()
+    try:
+        check(st)
+    finally:
+        st.close()
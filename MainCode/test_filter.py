@@ -0,0 +1,38 @@
+from aiogram.types import MessageEntity
+
+from MainBot import ContentFilter, has_link
+
+TEXT = "смотри https://evil.example/x"
+
+
+def entity(kind: str, offset: int, length: int, **kw) -> MessageEntity:
+    return MessageEntity(type=kind, offset=offset, length=length, **kw)
+
+
+def test_link_found_despite_formatting_entities():
+    f = ContentFilter()
+    assert has_link(TEXT)
+    for e in (entity("bold", 0, 6), entity("code", 0, 6), entity("code", 7, 22), entity("pre", 7, 22)):
+        assert f.scan(TEXT, [e]).has_link, e.type
+
+
+def test_link_entities():
+    f = ContentFilter()
+    assert f.scan(TEXT, [entity("url", 7, 22)]).has_link
+    assert f.scan("жми сюда", [entity("text_link", 4, 4, url="https://evil.example")]).has_link
+    assert not f.scan("привет", [entity("bold", 0, 6)]).has_link
+
+
+def test_allowed_domain_does_not_hide_link_in_code():
+    f = ContentFilter()
+    f.load({"allow_domains": ["youtube.com"]})
+    assert not f.scan("https://youtube.com/a", [entity("url", 0, 21)]).has_link
+    text = "https://youtube.com/a https://evil.example/x"
+    assert f.scan(text, [entity("url", 0, 21), entity("code", 22, 22)]).has_link
+
+
+def test_deny_domain_and_words():
+    f = ContentFilter()
+    f.load({"deny_domains": ["evil.example"], "banned_words": ["спам"]})
+    assert f.scan(TEXT, [entity("bold", 0, 6)]).reject == ContentFilter.DENY_TEXT
+    assert f.scan("это спам", [entity("italic", 0, 3)]).reject == ContentFilter.WORD_TEXT
@@ -0,0 +1,166 @@
+import asyncio
+import itertools
+import os
+import re
+import socket
+import tempfile
+import time
+from collections import defaultdict
+
+from aiohttp import ClientSession, web
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+
+from MainBot import AsyncRepo, Config, Repo, WebhookServer, build_dispatcher
+
+TOKEN = "123:webhook-test"
+SECRET = "s3cret"
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "bot", "username": "anonbot"}
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class FakeTelegram:
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.port = free_port()
+        self.sent: dict[int, list[tuple[float, str]]] = defaultdict(list)
+        self.webhook = ""
+        self._mid = itertools.count(1)
+        self._runner: web.AppRunner = None
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        data = await request.post()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if method == "getMe":
+            result = BOT_USER
+        elif method == "setWebhook":
+            self.webhook = data["url"]
+            result = True
+        elif method == "sendMessage":
+            chat_id = int(data["chat_id"])
+            self.sent[chat_id].append((time.monotonic(), data["text"]))
+            result = {
+                "message_id": next(self._mid), "date": int(time.time()), "text": data["text"],
+                "chat": {"id": chat_id, "type": "private"}, "from": BOT_USER,
+            }
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, "127.0.0.1", self.port).start()
+
+    async def close(self) -> None:
+        await self._runner.cleanup()
+
+    async def wait_text(self, chat_id: int, needle: str, timeout: float = 5.0) -> str:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            for _, text in self.sent.get(chat_id, ()):
+                if needle in text:
+                    return text
+            await asyncio.sleep(0.01)
+        raise AssertionError(f"no message containing {needle!r} for chat {chat_id}: {self.sent.get(chat_id)}")
+
+
+class Harness:
+    def __init__(self, latency: float = 0.0, max_concurrent_updates: int = 64):
+        self.tg = FakeTelegram(latency)
+        self.cfg = Config(
+            token=TOKEN, admin_id=0, db_path=os.path.join(tempfile.mkdtemp(prefix="anon-wh-"), "wh.db"),
+            mode="webhook", webhook_url="https://example.test", webhook_port=free_port(), webhook_secret=SECRET,
+            max_concurrent_updates=max_concurrent_updates, send_global_rate=1e9, send_chat_rate=1e9,
+        )
+        self.url = f"http://127.0.0.1:{self.cfg.webhook_port}{self.cfg.webhook_path}"
+        self._ids = itertools.count(1)
+
+    async def __aenter__(self) -> "Harness":
+        await self.tg.start()
+        self.repo = AsyncRepo(Repo(self.cfg.db_path), 2)
+        await self.repo.init()
+        api = TelegramAPIServer.from_base(f"http://127.0.0.1:{self.tg.port}")
+        self.bot = Bot(TOKEN, session=AiohttpSession(api=api))
+        self.server = WebhookServer(self.cfg, self.bot, build_dispatcher(self.cfg, self.bot, self.repo))
+        self.task = asyncio.create_task(self.server.run())
+        self.http = ClientSession()
+        deadline = time.monotonic() + 5
+        while not self.tg.webhook:
+            assert time.monotonic() < deadline and not self.task.done(), "webhook was not registered"
+            await asyncio.sleep(0.01)
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.http.close()
+        self.task.cancel()
+        await asyncio.gather(self.task, return_exceptions=True)
+        self.repo.close()
+        await self.tg.close()
+
+    async def post(self, update: dict, secret: str = SECRET) -> int:
+        async with self.http.post(self.url, json=update, headers={"X-Telegram-Bot-Api-Secret-Token": secret}) as r:
+            return r.status
+
+    async def message(self, user_id: int, text: str) -> int:
+        i = next(self._ids)
+        return await self.post({"update_id": i, "message": {
+            "message_id": i, "date": int(time.time()), "text": text,
+            "chat": {"id": user_id, "type": "private"}, "from": {"id": user_id, "is_bot": False, "first_name": "u"},
+        }})
+
+
+def test_rejects_wrong_secret():
+    async def run():
+        async with Harness() as h:
+            assert h.tg.webhook == "https://example.test/webhook"
+            assert await h.post({"update_id": 1}, secret="wrong") == 401
+            assert await h.post({"update_id": 1}, secret="") == 401
+    asyncio.run(run())
+
+
+def test_start_then_message_is_delivered_in_order():
+    async def run():
+        async with Harness(latency=0.005) as h:
+            assert await h.message(200, "/start") == 200
+            code = re.search(r"start=u_(\S+)", await h.tg.wait_text(200, "start=u_")).group(1)
+            for i in range(20):
+                await h.message(100 + i, f"/start u_{code}")
+                await h.message(100 + i, f"вопрос {i}")
+            for i in range(20):
+                await h.tg.wait_text(200, f"вопрос {i}")
+                await h.tg.wait_text(100 + i, "Отправлено")
+    asyncio.run(run())
+
+
+def test_burst_of_one_user_does_not_starve_others():
+    async def run():
+        async with Harness(latency=0.05, max_concurrent_updates=4) as h:
+            burst_posts = [asyncio.create_task(h.message(300, "hello")) for _ in range(40)]
+            await h.tg.wait_text(300, "Чтобы отправить")
+            t0 = time.monotonic()
+            await h.message(400, "/id")
+            await h.tg.wait_text(400, "Ваш ID")
+            other = h.tg.sent[400][0][0] - t0
+            assert other < 0.5, f"other user's update waited {other:.2f}s behind the burst"
+            burst = [t for t, _ in h.tg.sent[300]]
+            assert len(burst) < 40, "burst finished before the other user's update was measured"
+            assert set(await asyncio.gather(*burst_posts)) == {200}
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    for name, fn in list(globals().items()):
+        if name.startswith("test_"):
+            fn()
+            print(f"{name}: ok")